@@ -8,68 +8,437 @@ with Jeri in-browser visualization tool.
 
 import glob
 import os
+import base64
 import sys
 import argparse
-import pyexr
+import tempfile
+import threading
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import cv2
-import matplotlib.pyplot as plt
-from PIL import Image
 import json
 import csv
 import math
-from metric import compute_metric, falsecolor, falsecolor_np
+import hashlib
+from metric import compute_metrics, compute_metrics_tiled, falsecolor, falsecolor_np, save_png, \
+    tonemap, ImageCache, atomic_write, load_exr, make_sidecar, profiler
 
 NP_INT_TYPES = [np.int8, np.int16, np.int32, np.int64,
                 np.uint8, np.uint16, np.uint32, np.uint64]
 
 
-def generate_thumbnail(path_dir, ref):
+class ImageWriter(object):
+    """Encode and write images on background threads.
+    At most max_pending images are held in memory; saving more blocks
+    until earlier writes are done. Use flush() before relying on the files.
+    If pyramid is set, viewer images also get a tiled mip pyramid with
+    tiles of that many pixels; hdr adds half float tiles of HDR images to it
+    (with 256 px tiles if no pyramid is given).
+    Images saved with save() are skipped if their content did not change
+    since they were last written (unless rewrite is set); with an assets
+    directory, viewer images are stored there under their content hash.
+    """
+
+    def __init__(self, workers=2, max_pending=None, pyramid=None, hdr=False,
+                 rewrite=False, assets=None):
+        self.pyramid = pyramid or (256 if hdr else None)
+        self.hdr = hdr
+        self.rewrite = rewrite
+        self.assets = assets
+        if assets and not os.path.exists(assets):
+            os.makedirs(assets)
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='writer') if workers > 0 else None
+        self.slots = threading.BoundedSemaphore(max_pending or 2 * max(workers, 1))
+        self.futures = []
+        self.lock = threading.Lock()
+        self.manifests = {}
+        self.written, self.skipped = 0, 0
+
+    def submit(self, fn, *args):
+        """Call fn(*args) in the background (or right away without workers)."""
+
+        if self.pool is None:
+            fn(*args)
+            return
+        self.slots.acquire()
+        future = self.pool.submit(fn, *args)
+        future.add_done_callback(lambda f: self.slots.release())
+        self.futures.append(future)
+
+    def save(self, path_dir, fname, key, fn, *args):
+        """Write path_dir/fname with fn(*args), unless the file is unchanged
+        since it was last written with the same content key (see assets.json).
+        """
+
+        path = os.path.join(path_dir, fname)
+        with self.lock:
+            if path_dir not in self.manifests:
+                self.manifests[path_dir] = (load_assets(path_dir), {})
+            manifest, updates = self.manifests[path_dir]
+            entry = updates.get(fname) or manifest.get(fname)
+        if not self.rewrite and entry is not None and entry['key'] == key \
+                and os.path.exists(path) and entry['stamp'] == asset_stamp(path):
+            self.skipped += 1
+            return
+
+        def write():
+            fn(*args)
+            with self.lock:
+                updates[fname] = {'key': key, 'stamp': asset_stamp(path)}
+        self.written += 1
+        self.submit(write)
+
+    def flush(self):
+        """Wait for all pending writes, raising the first error if any,
+        and record the written files in their directory's assets.json.
+        """
+
+        futures, self.futures = self.futures, []
+        with profiler.stage('writer/wait'):
+            for future in futures:
+                future.result()
+
+        with self.lock:
+            manifests = [(path_dir, updates) for path_dir, (_, updates)
+                         in self.manifests.items() if updates]
+            self.manifests = {}
+        for path_dir, updates in manifests:
+            # Merge with entries written by concurrent runs meanwhile
+            with scene_lock(path_dir):
+                manifest = load_assets(path_dir)
+                manifest.update(updates)
+                atomic_write(os.path.join(path_dir, 'assets.json'),
+                             json.dumps(manifest, indent=1, sort_keys=True))
+
+    def close(self):
+        """Flush pending writes and stop worker threads."""
+
+        self.flush()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def save_asset(writer, path_dir, fname, key, fn, *args):
+    """Save path_dir/fname with fn(*args) unless its content key is unchanged
+    (only with an ImageWriter, otherwise it is always written)."""
+
+    if writer is None:
+        fn(*args)
+    else:
+        writer.save(path_dir, fname, key, fn, *args)
+
+
+def asset_key(img, *params):
+    """Content key of a generated file: hash of its pixels and of the
+    parameters of its encoding."""
+
+    h = hashlib.sha1(hash_img(img).encode('utf8'))
+    h.update(repr(params).encode('utf8'))
+    return h.hexdigest()
+
+
+def asset_stamp(path):
+    """Modification stamp of a generated file. For a tile directory, it covers
+    all its files, so that deleted or modified tiles are written again.
+    """
+
+    if os.path.isdir(path):
+        stamps = [asset_stamp(os.path.join(root, f))
+                  for root, _, files in os.walk(path) for f in files]
+        return [max([s[0] for s in stamps], default=0), sum(s[1] for s in stamps), len(stamps)]
+    st = os.stat(path)
+    return [st.st_mtime, st.st_size]
+
+
+def load_assets(path_dir):
+    """Load content keys of the files generated in a directory."""
+
+    fname = os.path.join(path_dir, 'assets.json')
+    if not os.path.exists(fname):
+        return {}
+    try:
+        with open(fname, 'r') as fp:
+            return json.load(fp)
+    except ValueError:
+        return {}
+
+
+def pyramid_levels(width, height, tile):
+    """Number of mip levels needed to reduce an image to a single tile."""
+
+    levels = 1
+    while width > tile or height > tile:
+        width, height = (width + 1) // 2, (height + 1) // 2
+        levels += 1
+    return levels
+
+
+def save_pyramid(tiles_dir, img, tile=256):
+    """Save 8-bit or [0, 1] floating point image as a tiled mip pyramid.
+    Tiles are written to tiles_dir/<level>/<row>_<col>.png; level 0 is full
+    resolution and each level halves the previous one (rounding up).
+    """
+
+    from PIL import Image
+
+    with profiler.stage('pyramid', img.nbytes, file=os.path.basename(tiles_dir)):
+        if img.dtype != np.uint8:
+            img = (img * 255).astype(np.uint8)
+        img = Image.fromarray(img)
+
+        for level in range(pyramid_levels(img.size[0], img.size[1], tile)):
+            if level > 0:
+                w, h = img.size
+                img = img.resize(((w + 1) // 2, (h + 1) // 2), resample=Image.BOX)
+            level_dir = os.path.join(tiles_dir, str(level))
+            if not os.path.exists(level_dir):
+                os.makedirs(level_dir)
+            w, h = img.size
+            for y in range(0, h, tile):
+                for x in range(0, w, tile):
+                    box = (x, y, min(x + tile, w), min(y + tile, h))
+                    img.crop(box).save(os.path.join(
+                        level_dir, '{}_{}.png'.format(y // tile, x // tile)))
+
+
+def save_hdr_pyramid(tiles_dir, img, tile=256):
+    """Save HDR image as raw half float tiles next to its PNG pyramid.
+    Tiles are written to tiles_dir/<level>/<row>_<col>.f16, as little-endian
+    row-major pixels; each level averages 2x2 blocks of the previous one.
+    """
+
+    with profiler.stage('pyramid/hdr', img.nbytes, file=os.path.basename(tiles_dir)):
+        img = np.asarray(img, dtype=np.float32)
+        if img.ndim == 2:
+            img = img[:, :, np.newaxis]
+
+        for level in range(pyramid_levels(img.shape[1], img.shape[0], tile)):
+            if level > 0:
+                h, w = img.shape[:2]
+                img = np.pad(img, ((0, h % 2), (0, w % 2), (0, 0)), mode='edge')
+                img = img.reshape(img.shape[0] // 2, 2, img.shape[1] // 2, 2, -1).mean(axis=(1, 3))
+            level_dir = os.path.join(tiles_dir, str(level))
+            if not os.path.exists(level_dir):
+                os.makedirs(level_dir)
+            half = np.clip(img, -65504, 65504).astype('<f2')
+            h, w = half.shape[:2]
+            for y in range(0, h, tile):
+                for x in range(0, w, tile):
+                    fname = os.path.join(level_dir, '{}_{}.f16'.format(y // tile, x // tile))
+                    np.ascontiguousarray(half[y:y + tile, x:x + tile]).tofile(fname)
+
+
+def image_entry(path_dir, title, fname, img, writer=None, hdr=None):
+    """Save viewer image and return its data.js entry.
+    With a pyramid writer, the entry also describes the tiles for lazy loading,
+    and if requested, the half float tiles of the hdr image img was tonemapped from.
+    """
+
+    # Content keys are only needed to skip unchanged files, with a writer
+    key = asset_key(img, 'png') if writer is not None else None
+    store = path_dir
+    if writer is not None and writer.assets:
+        # Content-addressed file, referenced relative to the scene
+        store = writer.assets
+        fname = '{}.png'.format(key[:20])
+    save_asset(writer, store, fname, key, save_png, os.path.join(store, fname), img)
+    entry = {'title': title, 'version': '-',
+             'image': os.path.relpath(os.path.join(store, fname), path_dir)}
+
+    tile = writer.pyramid if writer is not None else None
+    if tile:
+        tiles_dir = '{}_tiles'.format(os.path.splitext(fname)[0])
+        hdr_tiles = hdr is not None and writer.hdr
+        key = asset_key(img, 'tiles', tile, hash_img(hdr) if hdr_tiles else None)
+        if writer.assets:
+            tiles_dir = '{}_tiles'.format(key[:20])
+        h, w = img.shape[:2]
+        entry['tiles'] = {'path': os.path.relpath(os.path.join(store, tiles_dir), path_dir),
+                          'width': w, 'height': h, 'size': tile,
+                          'levels': pyramid_levels(w, h, tile)}
+        if hdr_tiles:
+            entry['tiles']['hdr'] = 1 if hdr.ndim == 2 else hdr.shape[2]
+
+        def save_tiles(tiles_path):
+            save_pyramid(tiles_path, img, tile)
+            if hdr_tiles:
+                save_hdr_pyramid(tiles_path, hdr, tile)
+        save_asset(writer, store, tiles_dir, key, save_tiles, os.path.join(store, tiles_dir))
+    return entry
+
+
+def generate_thumbnail(path_dir, ref, writer=None):
     """Generate thumbnail image for index."""
 
-    thumb_w, thumb_h = 640, 360
-    img = Image.fromarray((pyexr.tonemap(ref) * 255).astype(np.uint8))
-    w, h = img.size
-    resized_h = [w, h].index(max([w, h]))
-    ratio = thumb_h / h if resized_h else thumb_w / w
+    from PIL import Image
 
-    w, h = int(w * ratio), int(h * ratio)
-    thumb = img.resize((w, h), resample=Image.BICUBIC)
+    with profiler.stage('thumbnail', ref.nbytes):
+        thumb_w, thumb_h = 640, 360
+        img = Image.fromarray((tonemap(ref) * 255).astype(np.uint8))
+        w, h = img.size
+        resized_h = [w, h].index(max([w, h]))
+        ratio = thumb_h / h if resized_h else thumb_w / w
+
+        w, h = int(w * ratio), int(h * ratio)
+        thumb = img.resize((w, h), resample=Image.BICUBIC)
+
+        bg = Image.new('RGBA', (thumb_w, thumb_h), (0, 0, 0, 255))
+        if resized_h:
+            bg.paste(thumb, (int((thumb_w - w) / 2), 0))
+        else:
+            bg.paste(thumb, (0, int((thumb_h - h) / 2)))
+
+    key = hashlib.sha1(bg.tobytes()).hexdigest() if writer is not None else None
+    save_asset(writer, path_dir, 'thumb.png', key, bg.save, os.path.join(path_dir, 'thumb.png'))
 
-    bg = Image.new('RGBA', (thumb_w, thumb_h), (0, 0, 0, 255))
-    if resized_h:
-        bg.paste(thumb, (int((thumb_w - w) / 2), 0))
-    else:
-        bg.paste(thumb, (0, int((thumb_h - h) / 2)))
 
-    bg.save(os.path.join(path_dir, 'thumb.png'))
+def hash_img(img):
+    """Hash image content, used to invalidate cached metrics."""
 
+    h = hashlib.sha1('{}{}'.format(img.shape, img.dtype).encode('utf8'))
+    h.update(np.ascontiguousarray(img))
+    return h.hexdigest()
 
-def write_data(path_dir, data):
-    """Update JS dictionary files."""
 
-    with open(os.path.join(path_dir, 'data.json'), 'w') as fp:
-        json.dump(data, fp, indent=4)
+def load_cache(path_dir):
+    """Load metric cache sidecar of a scene (empty if missing or corrupted)."""
 
-    data_js = 'const data =\n' + json.dumps(data, indent=4)
-    with open(os.path.join(path_dir, 'data.js'), 'w') as fp:
-        fp.write(data_js)
+    cache_path = os.path.join(path_dir, 'cache.json')
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path, 'r') as fp:
+            return json.load(fp)
+    except ValueError:
+        print('Warning: ignoring corrupted cache {}'.format(cache_path))
+        return {}
 
 
-def hdr_to_ldr(path_dir, img):
+def write_cache(path_dir, cache):
+    """Write metric cache sidecar next to data.json."""
+
+    atomic_write(os.path.join(path_dir, 'cache.json'), json.dumps(cache))
+
+
+def write_if_changed(fname, text):
+    """Write text file atomically, unless it already has this content."""
+
+    if os.path.exists(fname):
+        with open(fname, 'r') as fp:
+            if fp.read() == text:
+                return
+    atomic_write(fname, text)
+
+
+def encode_track(track, chunks):
+    """Encode convergence track for a data chunk (float32 as base64 strings)."""
+
+    if chunks != 'float32':
+        return track
+    def pack(seq): return base64.b64encode(np.asarray(seq, dtype='<f4').tobytes()).decode('ascii')
+    return {'x': [pack(x) for x in track['x']], 'y': [pack(y) for y in track['y']],
+            'dtype': 'float32'}
+
+
+def decode_track(track):
+    """Decode convergence track read from a data chunk."""
+
+    if track.get('dtype') != 'float32':
+        return track
+    def unpack(b64): return np.frombuffer(base64.b64decode(b64), dtype='<f4').tolist()
+    return {'x': [unpack(x) for x in track['x']], 'y': [unpack(y) for y in track['y']]}
+
+
+def write_data(path_dir, data, chunks=None):
+    """Update JS dictionary files.
+    With chunks ('json' or 'float32', defaults to the layout data was read
+    with), data.js only holds an index: image boxes and convergence tracks go
+    to data/*.js chunks loaded on demand by the viewer. Only files whose
+    content changed are rewritten.
+    """
+
+    with profiler.stage('json'):
+        chunks = chunks or data.get('chunks')
+        if not chunks:
+            data_json = json.dumps(data, indent=4)
+            atomic_write(os.path.join(path_dir, 'data.json'), data_json)
+            atomic_write(os.path.join(path_dir, 'data.js'), 'const data =\n' + data_json)
+            return
+
+        chunk_dir = os.path.join(path_dir, 'data')
+        if not os.path.exists(chunk_dir):
+            os.makedirs(chunk_dir)
+
+        def write_chunk(name, value):
+            # Chunks are scripts so that they also load from file:// pages
+            path = 'data/{}.js'.format(name)
+            text = 'dataChunk({}, {});\n'.format(json.dumps(path),
+                                                 json.dumps(value, separators=(',', ':')))
+            write_if_changed(os.path.join(path_dir, path), text)
+            return path
+
+        index = dict(data, chunks=chunks, imageBoxes=[], stats=[])
+        for b, box in enumerate(data['imageBoxes']):
+            chunk = write_chunk('box-{}'.format(b), box['elements'])
+            index['imageBoxes'].append({'title': box['title'], 'chunk': chunk})
+        for stat in data['stats']:
+            series = []
+            for entry in stat['series']:
+                if 'track' not in entry:
+                    series.append(entry)
+                    continue
+                chunk = write_chunk('track-{}'.format(entry['label']),
+                                    encode_track(entry['track'], chunks))
+                series.append({'label': entry['label'], 'data': entry['data'], 'chunk': chunk})
+            index['stats'].append(dict(stat, series=series))
+
+        index_json = json.dumps(index, separators=(',', ':'))
+        write_if_changed(os.path.join(path_dir, 'data.json'), index_json)
+        write_if_changed(os.path.join(path_dir, 'data.js'), 'const data =\n' + index_json)
+
+
+def read_data(path_dir):
+    """Read JS dictionary written by write_data, in either layout."""
+
+    with open(os.path.join(path_dir, 'data.json'), 'r') as fp:
+        data = json.load(fp)
+    if not data.get('chunks'):
+        return data
+
+    def read_chunk(path):
+        with open(os.path.join(path_dir, path), 'r') as fp:
+            text = fp.read()
+        prefix = 'dataChunk({}, '.format(json.dumps(path))
+        return json.loads(text[len(prefix):text.rindex(');')])
+
+    for box in data['imageBoxes']:
+        box['elements'] = read_chunk(box.pop('chunk'))
+    for stat in data['stats']:
+        for entry in stat['series']:
+            if 'chunk' in entry:
+                entry['track'] = decode_track(read_chunk(entry.pop('chunk')))
+    return data
+
+
+def hdr_to_ldr(path_dir, img, writer=None):
     """HDR to LDR conversion for web display."""
 
     # Image already in ldr
+    hdr = None
     if (img['data'].dtype in NP_INT_TYPES):
-        ldr = Image.fromarray(img['data'].astype(np.uint8))
+        ldr = img['data'].astype(np.uint8)
     else:
-        ldr = Image.fromarray(
-            (pyexr.tonemap(img['data']) * 255).astype(np.uint8))
+        hdr = img['data']
+        with profiler.stage('tonemap', hdr.nbytes, image=img['name']):
+            ldr = (tonemap(hdr) * 255).astype(np.uint8)
     ldr_fname = '{}.png'.format(img['name'])
-    ldr_path = os.path.join(path_dir, ldr_fname)
-    ldr.save(ldr_path)
-    ldr_entry = {'title': img['name'], 'version': '-', 'image': ldr_fname}
-    return ldr_entry
+    return image_entry(path_dir, img['name'], ldr_fname, ldr, writer, hdr)
 
 
 def parse_stats(test_dirs, test_names):
@@ -102,14 +471,81 @@ def parse_stats(test_dirs, test_names):
     return stat_dicts
 
 
-def track_convergence(data, ref, test_dirs, metrics, eps=1e-2):
-    """Track error convergence over partial renders."""
+def score_partial(ref, partial_f, metrics, eps=1e-2, tile=None):
+    """Compute all metric means on a single (ref, partial) pair.
+    If tile is given, OpenEXR partials are streamed by blocks of tile rows.
+    """
+
+    with profiler.stage('track/partial', file=os.path.basename(partial_f)):
+        metric_dict = {}
+        if tile:
+            test = partial_f if partial_f.endswith('.exr') else load_img(partial_f)
+            stats = compute_metrics_tiled(ref, test, metrics, eps, tile,
+                                          dtype=ref.dtype)
+            for metric in metrics:
+                metric_dict[metric] = '{:.6f}'.format(stats[metric].mean)
+        else:
+            # Each partial is only read once: keep it out of the image cache
+            test = load_exposed(partial_f, ref.dtype)
+            errors = compute_metrics(ref, test, metrics, eps, full=False)
+            for metric in metrics:
+                metric_dict[metric] = '{:.6f}'.format(errors[metric][1])
+        return metric_dict
+
+
+# Reference shared read-only by pool workers (memory-mapped, never pickled)
+_worker_ref = None
+
+
+def _init_worker(ref_path, cache_bytes):
+    """Memory-map the shared reference in a pool worker, whose image cache
+    gets the same memory budget as the parent's."""
+    global _worker_ref
+    _worker_ref = np.load(ref_path, mmap_mode='r')
+    image_cache.max_bytes = cache_bytes
+    # Stages of workers are not recorded (see Profiler)
+    profiler.enabled = False
+
+
+def _score_worker(job):
+    """Score one partial render against the shared reference."""
+    partial_f, metrics, eps, tile = job
+    return score_partial(_worker_ref, partial_f, metrics, eps, tile)
+
+
+def score_partials(ref, partial_files, metrics, eps=1e-2, jobs=1, tile=None):
+    """Score partial renders, fanning out over a process pool if jobs > 1.
+    Results are returned in the same order as partial_files.
+    """
+
+    if jobs <= 1 or len(partial_files) <= 1:
+        return [score_partial(ref, f, metrics, eps, tile) for f in partial_files]
+
+    # Dump reference once so that workers can memory-map it
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ref_path = os.path.join(tmp_dir, 'ref.npy')
+        np.save(ref_path, ref)
+        work = [(f, metrics, eps, tile) for f in partial_files]
+        # Workers are spawned rather than forked: writer threads may be
+        # running, and a forked child would inherit their locks mid-write
+        ctx = mp.get_context('spawn')
+        with ctx.Pool(jobs, initializer=_init_worker,
+                         initargs=(ref_path, image_cache.max_bytes)) as pool:
+            return pool.map(_score_worker, work)
+
+
+def track_convergence(data, ref, test_dirs, metrics, eps=1e-2, jobs=1,
+                      cache=None, tile=None):
+    """Track error convergence over partial renders.
+    If a cache dictionary is given, only new or modified partials are scored,
+    and entries of partials which no longer exist are dropped from it.
+    """
 
     def num_order(x): return int(x.split('_')[-1].split('.')[0])
     def round_10(x): return int(round(x))
 
     # All partial directories (one per algorithm)
-    all_stats = []
+    all_files = []
     for partial_dir in test_dirs:
         # Determine extension by checking first partial file
         name = partial_dir.split(os.path.sep)[-1].replace('_partial', '')
@@ -119,21 +555,43 @@ def track_convergence(data, ref, test_dirs, metrics, eps=1e-2):
         glob_expr = os.path.join(partial_dir, '{}_[0-9]*.{}'.format(name, ext))
         partial_files = glob.glob(glob_expr)
         partial_files = sorted(partial_files, key=num_order)
+        all_files.append(partial_files)
 
-        # All partial images within a directory
-        dir_stat = []
-        for partial_f in partial_files:
-            test = load_img(partial_f)
-
-            # Compute all metrics on (ref, test) pair
-            metric_dict = {}
-            for metric in metrics:
-                err_img = compute_metric(ref, test, metric.lower(), eps)
-                err_mean = '{:.6f}'.format(np.mean(err_img))
-                metric_dict[metric] = err_mean
-            dir_stat.append(metric_dict)
+    # Score all partial images at once, then split back per directory
+    flat_files = [f for files in all_files for f in files]
+    if cache is None:
+        flat_stats = score_partials(ref, flat_files, metrics, eps, jobs, tile)
+    else:
+        # Cache entries are keyed on file path, checked against file
+        # stamp (mtime, size), reference content, epsilon and precision
+        ref_hash, dtype = hash_img(ref), str(ref.dtype)
+        keys, stamps, todo = {}, {}, []
+        for f in flat_files:
+            st = os.stat(f)
+            keys[f] = os.path.abspath(f)
+            stamps[f] = [st.st_mtime, st.st_size]
+            entry = cache.get(keys[f])
+            valid = entry is not None and entry['stamp'] == stamps[f] \
+                and entry['ref'] == ref_hash and entry['eps'] == eps \
+                and entry.get('dtype') == dtype
+            if not valid:
+                cache[keys[f]] = {'stamp': stamps[f], 'ref': ref_hash,
+                                  'eps': eps, 'dtype': dtype, 'metrics': {}}
+            if not all(m in cache[keys[f]]['metrics'] for m in metrics):
+                todo.append(f)
+
+        scored = score_partials(ref, todo, metrics, eps, jobs, tile)
+        for f, metric_dict in zip(todo, scored):
+            cache[keys[f]]['metrics'].update(metric_dict)
+        # Drop deleted or renamed partials
+        for key in set(cache) - set(keys.values()):
+            del cache[key]
+        flat_stats = [cache[keys[f]]['metrics'] for f in flat_files]
 
-        all_stats.append(dir_stat)
+    all_stats = []
+    for files in all_files:
+        all_stats.append(flat_stats[:len(files)])
+        flat_stats = flat_stats[len(files):]
 
     # Not sure if there's a better way to do this, maybe using itertools.chain?
     all_metrics = {}
@@ -163,49 +621,229 @@ def track_convergence(data, ref, test_dirs, metrics, eps=1e-2):
                     entry['track']['y'].append(all_metrics[metric][t])
 
 
-def update_stats(path_dir, data, ref, tests, metrics, clip, eps=1e-2):
-    """Update some entries of data.js; assumes it was already created."""
+def positive_log(x):
+    """Natural log, with non-positive values clamped to a tiny value."""
 
-    def find_idx(t, d): return list(d['stats'][0]['labels']).index(t['name'])
+    return np.log(np.maximum(np.asarray(x, dtype=np.float64), 1e-12))
 
-    for test in tests:
-        # Check if entry exists
-        is_new = test['name'] not in data['stats'][0]['labels']
 
-        # Update dictionary
-        if is_new:
-            data['imageBoxes'][0]['elements'].append(
-                hdr_to_ldr(path_dir, test))
-            data['stats'][0]['labels'].append(test['name'])
+def time_to_error(x, y, thresholds):
+    """First times at which a convergence track reaches each error threshold,
+    interpolated in log-log space between samples (None if never reached).
+    """
+
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    if len(x) == 0:
+        return [None] * len(thresholds)
+    hit = y[np.newaxis, :] <= thresholds[:, np.newaxis]
+    i = np.argmax(hit, axis=1)
+    lx, ly, lt = positive_log(x), positive_log(y), positive_log(thresholds)
+
+    # Crossing between samples i - 1 and i (or at the first sample)
+    prev = np.maximum(i - 1, 0)
+    dy = ly[i] - ly[prev]
+    w = np.where(dy != 0, (lt - ly[prev]) / np.where(dy != 0, dy, 1), 1)
+    times = np.where(i > 0, np.exp(lx[prev] + np.clip(w, 0, 1) * (lx[i] - lx[prev])), x[0])
+    return [float(t) if reached else None for t, reached in zip(times, hit.any(axis=1))]
+
+
+def resample_track(x, y, grid):
+    """Resample a convergence track on the points of a time grid within its
+    time range, interpolating in log-log space.
+    """
+
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    valid = (x > 0) & (y > 0)
+    x, y = x[valid], y[valid]
+    if len(x) == 0:
+        return [], []
+    grid = grid[(grid >= x[0]) & (grid <= x[-1])]
+    values = np.exp(np.interp(np.log(grid), np.log(x), np.log(y)))
+    return grid, values
+
+
+def lttb(x, y, n):
+    """Downsample a track to n points with Largest-Triangle-Three-Buckets,
+    measuring triangle areas in log-log space (as tracks are plotted).
+    """
+
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    if len(x) <= n or n < 3:
+        return x, y
+    lx, ly = positive_log(x), positive_log(y)
+
+    # Inner points split in n - 2 buckets, first and last points are kept
+    edges = (np.arange(n - 1) * (len(x) - 2) / float(n - 2)).astype(int) + 1
+    edges[-1] = len(x) - 1
+    keep = [0]
+    for b in range(n - 2):
+        lo, hi = edges[b], edges[b + 1]
+        if b + 2 < len(edges):
+            cx, cy = lx[hi:edges[b + 2]].mean(), ly[hi:edges[b + 2]].mean()
         else:
-            t = find_idx(test, data)
-            hdr_to_ldr(path_dir, test)
-
-        # Compute desired metrics
-        for m, metric in enumerate(metrics):
-            # Recompute error
-            err_img = compute_metric(ref, test['data'], metric.lower(), eps)
-            err_mean = '{:.6f}'.format(np.mean(err_img))
-            if is_new:
-                data['stats'][0]['series'][m]['data'].append(err_mean)
-            else:
-                data['stats'][0]['series'][m]['data'][t] = err_mean
-
-            # Recompute false color heatmap and save to files
+            cx, cy = lx[-1], ly[-1]
+        a = keep[-1]
+        area = np.abs((lx[a] - cx) * (ly[lo:hi] - ly[a]) - (lx[a] - lx[lo:hi]) * (cy - ly[a]))
+        keep.append(lo + int(np.argmax(area)))
+    keep.append(len(x) - 1)
+    return x[keep], y[keep]
+
+
+def process_tracks(data, targets=None, grid=None, max_points=None):
+    """Post-process convergence tracks of data.js.
+    targets: list of (metric, error) whose time to error is added to data,
+    grid: number of points of a log-spaced time grid shared by all algorithms,
+    onto which tracks are resampled, max_points: longest track after LTTB.
+    """
+
+    stats = data['stats'][0]
+    for entry in stats['series']:
+        track = entry['track']
+        metric_targets = [e for m, e in (targets or []) if m.upper() == entry['label']]
+        for t, (x, y) in enumerate(zip(track['x'], track['y'])):
+            if metric_targets and t < len(stats['labels']):
+                times = time_to_error(x, y, metric_targets)
+                result = {'name': stats['labels'][t], 'targets': {}}
+                for error, time in zip(metric_targets, times):
+                    label = '{} <= {:g}'.format(entry['label'], error)
+                    result['targets'][label] = '' if time is None else '{:.1f}'.format(time)
+                merge_stats(data, result)
+
+        positive = [v for x in track['x'] for v in x if v > 0]
+        if grid and positive:
+            times = np.geomspace(min(positive), max(positive), grid)
+            resampled = [resample_track(x, y, times) for x, y in zip(track['x'], track['y'])]
+            track['x'] = [[float('{:.4g}'.format(v)) for v in x] for x, _ in resampled]
+            track['y'] = [[float('{:.6g}'.format(v)) for v in y] for _, y in resampled]
+
+        if max_points:
+            reduced = [lttb(x, y, max_points) for x, y in zip(track['x'], track['y'])]
+            track['x'] = [x.tolist() for x, _ in reduced]
+            track['y'] = [y.tolist() for _, y in reduced]
+
+
+def test_stats(path_dir, ref, test, metrics, clip, eps=1e-2, writer=None):
+    """Compute metrics of one test image and save its viewer images.
+    Returns the entries of the algorithm, to be merged into data.js with merge_stats.
+    """
+
+    with profiler.stage('image', image=test['name']):
+        result = {'name': test['name'], 'image': hdr_to_ldr(path_dir, test, writer),
+                  'metrics': {}}
+        errors = compute_metrics(ref, test['data'], metrics, eps)
+        for metric in metrics:
+            err_img, err_mean = errors[metric]
             fc = falsecolor(err_img, clip, eps)
             fc_fname = '{}-{}.png'.format(test['name'], metric.upper())
-            plt.imsave(os.path.join(path_dir, fc_fname), fc)
+            result['metrics'][metric.upper()] = {
+                'val': '{:.6f}'.format(err_mean),
+                'fc': image_entry(path_dir, test['name'], fc_fname, fc, writer)}
+        return result
+
+
+def merge_stats(data, result):
+    """Insert or replace the entries of one algorithm in data.js dictionary.
+    Images are matched by title and metrics by label, so results computed
+    with a subset of the metrics only update those. Each part of a result
+    is optional: a metric may only carry a convergence track ('track': {'x', 'y'}).
+    Times to reach target errors ('targets': {label: seconds}) go to a
+    separate 'Time to error' table.
+    """
+
+    def merge_element(box, entry):
+        titles = [e['title'] for e in box['elements']]
+        if entry['title'] in titles:
+            box['elements'][titles.index(entry['title'])] = entry
+        else:
+            box['elements'].append(entry)
+
+    stats = data['stats'][0]
+    if result['name'] not in stats['labels']:
+        stats['labels'].append(result['name'])
+        for entry in stats['series']:
+            entry['data'].append('')
+    t = stats['labels'].index(result['name'])
+    if 'image' in result:
+        merge_element(data['imageBoxes'][0], result['image'])
+
+    boxes = dict((box['title'], box) for box in data['imageBoxes'][1:])
+    for entry in stats['series']:
+        metric = result.get('metrics', {}).get(entry['label'])
+        if metric is None:
+            continue
+        if 'val' in metric:
+            entry['data'][t] = metric['val']
+        if 'fc' in metric:
+            merge_element(boxes[entry['label']], metric['fc'])
+        if 'track' in metric:
+            for axis in ['x', 'y']:
+                track = entry['track'][axis]
+                track.extend([[]] * (t + 1 - len(track)))
+                track[t] = metric['track'][axis]
+
+    missing = set(result.get('metrics', {})) - set(e['label'] for e in stats['series'])
+    if missing:
+        print('Warning: metrics {} are not in the scene, ignored'.format(sorted(missing)))
+
+    if result.get('targets'):
+        times = [stat for stat in data['stats'] if stat['title'] == 'Time to error']
+        if not times:
+            times = [{'title': 'Time to error', 'labels': [], 'series': []}]
+            data['stats'].append(times[0])
+        times = times[0]
+        if result['name'] not in times['labels']:
+            times['labels'].append(result['name'])
+            for entry in times['series']:
+                entry['data'].append('')
+        t = times['labels'].index(result['name'])
+        for label, seconds in sorted(result['targets'].items()):
+            series = [e for e in times['series'] if e['label'] == label]
+            if not series:
+                series = [{'label': label, 'data': [''] * len(times['labels'])}]
+                times['series'].append(series[0])
+            series[0]['data'][t] = seconds
+    return data
+
+
+def update_stats(path_dir, data, ref, tests, metrics, clip, eps=1e-2, writer=None):
+    """Update some entries of data.js; assumes it was already created."""
+
+    for test in tests:
+        merge_stats(data, test_stats(path_dir, ref, test, metrics, clip, eps, writer))
+    return data
+
+
+def scene_lock(path_dir):
+    """Advisory lock serializing updates of a scene's data files (Unix only).
+    Use as a context manager; the lock is released when the file is closed.
+    """
+
+    import fcntl
+
+    fp = open(os.path.join(path_dir, '.data.lock'), 'a')
+    fcntl.flock(fp, fcntl.LOCK_EX)
+    return fp
 
-            if is_new:
-                fc_entry = {'title': test['name'],
-                            'version': '-', 'image': fc_fname}
-                data['imageBoxes'][m+1]['elements'].append(fc_entry)
 
-    # TODO: Update stats.json
+def publish_stats(path_dir, results):
+    """Merge algorithm results into the scene's current data.js.
+    Runs under the scene lock and re-reads data right before merging, so
+    concurrent renders of different algorithms do not lose each other's entries.
+    """
+
+    with profiler.stage('publish'):
+        with profiler.stage('publish/lock'):
+            lock = scene_lock(path_dir)
+        with lock:
+            data = read_data(path_dir)
+            for result in results:
+                merge_stats(data, result)
+            write_data(path_dir, data)
     return data
 
 
-def compute_stats(path_dir, ref, tests, metrics, clip, negpos, eps=1e-2):
+def compute_stats(path_dir, ref, tests, metrics, clip, negpos, eps=1e-2, writer=None):
     """Generate all false color LDR maps and dictionary for JS.
        Assumes tests = {'name': 'my_alg', 'data': ...}
     """
@@ -213,33 +851,36 @@ def compute_stats(path_dir, ref, tests, metrics, clip, negpos, eps=1e-2):
     data = {}
     data['imageBoxes'] = [{'title': 'Images', 'elements': []}]
     data['stats'] = [{'title': 'Stats', 'labels': [], 'series': []}]
-    ref_entry = hdr_to_ldr(path_dir, {'name': 'Reference', 'data': ref})
+    ref_entry = hdr_to_ldr(path_dir, {'name': 'Reference', 'data': ref}, writer)
     data['imageBoxes'][0]['elements'].append(ref_entry)
 
     # Generate images and compute stats
     # Couldn't find a way to do it all in only two loops
     stats = []
     for t, test in enumerate(tests):
-        # Update dictionary
-        data['imageBoxes'][0]['elements'].append(hdr_to_ldr(path_dir, test))
-        data['stats'][0]['labels'].append(test['name'])
+        with profiler.stage('image', image=test['name']):
+            # Update dictionary
+            data['imageBoxes'][0]['elements'].append(
+                hdr_to_ldr(path_dir, test, writer))
+            data['stats'][0]['labels'].append(test['name'])
 
-        # Compute all metrics
-        stat_entry = {test['name']: {}}
-        stats.append(stat_entry)
-        for metric in metrics:
-            # Compute error
-            err_img = compute_metric(ref, test['data'], metric, eps)
-            err_mean = '{:.6f}'.format(np.mean(err_img))
+            # Compute all metrics
+            stat_entry = {test['name']: {}}
+            stats.append(stat_entry)
+            errors = compute_metrics(ref, test['data'], metrics, eps)
+            for metric in metrics:
+                # Compute error
+                err_img, err_mean = errors[metric]
+                err_mean = '{:.6f}'.format(err_mean)
 
-            # Compute false color heatmap and save to files
-            fc = falsecolor(err_img, clip, eps)
-            fc_fname = '{}-{}.png'.format(test['name'], metric.upper())
-            plt.imsave(os.path.join(path_dir, fc_fname), fc)
+                # Compute false color heatmap and save to files
+                fc = falsecolor(err_img, clip, eps)
+                fc_fname = '{}-{}.png'.format(test['name'], metric.upper())
+                fc_entry = image_entry(path_dir, test['name'], fc_fname, fc, writer)
 
-            # Save stats, if necessary
-            stats[t][test['name']][metric.upper()] = {
-                'val': err_mean, 'fc': fc_fname}
+                # Save stats, if necessary
+                stats[t][test['name']][metric.upper()] = {
+                    'val': err_mean, 'fc': fc_entry}
 
     # Write dictionary
     for metric in metrics:
@@ -249,9 +890,7 @@ def compute_stats(path_dir, ref, tests, metrics, clip, negpos, eps=1e-2):
 
         for t, test in enumerate(tests):
             # Add false color filenames to dict
-            fc_fname = stats[t][test['name']][metric.upper()]['fc']
-            entry = {'title': test['name'], 'version': '-', 'image': fc_fname}
-            fc_entry['elements'].append(entry)
+            fc_entry['elements'].append(stats[t][test['name']][metric.upper()]['fc'])
 
             # Add metric value to dict
             err_mean = stats[t][test['name']][metric.upper()]['val']
@@ -265,19 +904,19 @@ def compute_stats(path_dir, ref, tests, metrics, clip, negpos, eps=1e-2):
     if negpos:
         fc_entry = {'title': 'NP SMAPE', 'elements': []}
         for t, test in enumerate(tests):
-            # Compute the N/P false color image
-            fc = falsecolor_np(ref, test['data'], eps)
-            fc_fname = '{}-NP.png'.format(test['name'])
-            plt.imsave(os.path.join(path_dir, fc_fname), fc)
+            with profiler.stage('image', image=test['name']):
+                # Compute the N/P false color image
+                fc = falsecolor_np(ref, test['data'], eps)
+                fc_fname = '{}-NP.png'.format(test['name'])
 
-            # Save the fcname inside JSON
-            entry = {'title': test['name'], 'version': '-', 'image': fc_fname}
-            fc_entry['elements'].append(entry)
+                # Save the fcname inside JSON
+                entry = image_entry(path_dir, test['name'], fc_fname, fc, writer)
+                fc_entry['elements'].append(entry)
 
         # Update dictionary with false color filenames
         data['imageBoxes'].append(fc_entry)
 
-    generate_thumbnail(path_dir, ref)
+    generate_thumbnail(path_dir, ref, writer)
     return data
 
 
@@ -293,27 +932,49 @@ def detect_extension(filepath):
         raise Exception("Unsupported file extension for: {}".format(filepath))
 
 
-def load_img(filepath):
-    """Load HDR or LDR image (either .hdr or .exr for HDR or .png for LDR)."""
+def load_img(filepath, dtype=np.float32):
+    """Load HDR or LDR image (either .hdr or .exr for HDR or .png for LDR).
+    HDR images are converted to dtype (no copy for float32, their native type).
+    OpenEXR images with an up-to-date .npy sidecar are memory-mapped instead.
+    """
 
     if filepath.endswith('.exr'):
-        fp = pyexr.open(filepath)
-        img = np.array(fp.get(), dtype=np.float64)
+        img = load_exr(filepath, dtype)
     elif filepath.endswith('.hdr'):
-        fp = cv2.imread(filepath, cv2.IMREAD_ANYDEPTH)
-        fp = cv2.cvtColor(fp, cv2.COLOR_BGR2RGB)
-        img = np.array(fp, dtype=np.float64)
+        import cv2
+        with profiler.stage('decode', file=os.path.basename(filepath)) as stage:
+            fp = cv2.imread(filepath, cv2.IMREAD_ANYDEPTH)
+            fp = cv2.cvtColor(fp, cv2.COLOR_BGR2RGB)
+            img = np.asarray(fp, dtype=dtype)
+            stage.count(img.nbytes)
     elif filepath.endswith('.png'):
-        fp = cv2.imread(filepath)
-        fp = cv2.cvtColor(fp, cv2.COLOR_BGR2RGB)
-        # important to be signed, because some metrics' calculations can have intermediate negative values.
-        img = np.array(fp, dtype=np.int32)
+        import cv2
+        with profiler.stage('decode', file=os.path.basename(filepath)) as stage:
+            fp = cv2.imread(filepath)
+            fp = cv2.cvtColor(fp, cv2.COLOR_BGR2RGB)
+            # important to be signed, because some metrics' calculations can have intermediate negative values.
+            img = np.array(fp, dtype=np.int32)
+            stage.count(img.nbytes)
     else:
         raise Exception('Only HDR and OpenEXR and PNG images are supported')
 
     return img
 
 
+def load_exposed(filepath, dtype=np.float32, exposure=1.0):
+    """Load image and scale it by an exposure factor."""
+
+    img = load_img(filepath, dtype)
+    if exposure == 1.0 and img.dtype == dtype:
+        return img
+    return np.multiply(img, exposure, dtype=dtype)
+
+
+# Decoded images shared across all stages of a run (e.g. the reference of a
+# scene, scored against by every render of render.py)
+image_cache = ImageCache(load_exposed)
+
+
 if __name__ == '__main__':
     # Parse arguments
     parser = argparse.ArgumentParser(
@@ -341,8 +1002,47 @@ if __name__ == '__main__':
         '-d',   '--dir',       help='corresponding viewer scene directory', type=str, required=True)
     parser.add_argument('-A',   '--automatic',
                         help='scene directory for automatic mode', type=str)
+    parser.add_argument('-j',   '--jobs',
+                        help='worker processes for convergence tracking', type=int, default=1)
+    parser.add_argument('-nc',  '--nocache',
+                        help='ignore and do not update cached partial metrics', action='store_true')
+    parser.add_argument('-tl',  '--tile',
+                        help='stream partial renders by blocks of N rows', type=int)
+    parser.add_argument('-w',   '--writers',
+                        help='background threads encoding PNG images (0 to disable)', type=int, default=2)
+    parser.add_argument('-ic',  '--imgcache',
+                        help='memory budget for decoded images (MB)', type=int, default=2048)
+    parser.add_argument('-sp',  '--spill',
+                        help='directory where decoded images evicted from memory are kept', type=str)
+    parser.add_argument('-sc',  '--sidecar',
+                        help='convert reference to a memory-mapped .npy sidecar', action='store_true')
+    parser.add_argument('-dt',  '--dtype',
+                        help='floating point precision of images and error maps',
+                        choices=['float32', 'float64'], type=str, default='float32')
+    parser.add_argument('-pt',  '--pyramid',
+                        help='also write viewer images as a mip pyramid of N px tiles', type=int)
+    parser.add_argument('-ht',  '--hdrtiles',
+                        help='add half float tiles of HDR images to the pyramid', action='store_true')
+    parser.add_argument('-ch',  '--chunks',
+                        help='split data.js into an index and chunks loaded on demand',
+                        choices=['json', 'float32'], type=str)
+    parser.add_argument('-tte', '--time-to-error',
+                        help='add time to reach METRIC=VALUE errors to the stats', nargs='+', type=str)
+    parser.add_argument('-rs',  '--resample',
+                        help='resample convergence tracks on a shared log-spaced grid of N times', type=int)
+    parser.add_argument('-ds',  '--downsample',
+                        help='reduce convergence tracks to at most N points (LTTB)', type=int)
+    parser.add_argument('-rw',  '--rewrite',
+                        help='encode and write all images, even unchanged ones', action='store_true')
+    parser.add_argument('-as',  '--assets',
+                        help='directory where viewer images are stored under their content hash', type=str)
+    parser.add_argument('-pf',  '--profile',
+                        help='print time spent per stage; with FILE, also write a JSON report and FILE.trace.json',
+                        nargs='?', const='', type=str)
 
     args = parser.parse_args()
+    if args.profile is not None:
+        profiler.enable()
 
     # In automatic mode, check if conflicts with other arguments
     # Automatic mode can be used to save time during experiments
@@ -417,10 +1117,15 @@ if __name__ == '__main__':
         print('  * {}'.format(t))
 
     # Load images
-    ref = load_img(reference) * exposure
+    dtype = np.dtype(args.dtype)
+    image_cache.max_bytes = args.imgcache << 20
+    image_cache.spill_dir = args.spill
+    if args.sidecar and reference.endswith('.exr'):
+        make_sidecar(reference)
+    with profiler.stage('image', image='Reference'):
+        ref = image_cache.get(reference, dtype, exposure)
     test_configs, test_names = [], []
     for i, t in enumerate(tests):
-        img = load_img(t) * exposure
         if names:
             test_name = names[i]
         else:
@@ -428,15 +1133,38 @@ if __name__ == '__main__':
 
         # For e.g. handling greek symbols
         test_name = test_name.encode('utf8').decode('unicode_escape')
+        with profiler.stage('image', image=test_name):
+            img = image_cache.get(t, dtype, exposure)
         test_names.append(test_name)
         test_configs.append({'name': test_name, 'data': img})
 
     # Compute stats
     sys.stdout.write('Computing stats... ')
     sys.stdout.flush()
-    data = compute_stats(args.dir, ref, test_configs,
-                         args.metrics, args.clip, args.negpos, args.epsilon)
-    if (partials):
-        track_convergence(data, ref, partials, args.metrics, args.epsilon)
-    write_data(args.dir, data)
+    with ImageWriter(args.writers, pyramid=args.pyramid, hdr=args.hdrtiles,
+                     rewrite=args.rewrite, assets=args.assets) as writer:
+        data = compute_stats(args.dir, ref, test_configs, args.metrics,
+                             args.clip, args.negpos, args.epsilon, writer)
+        if (partials):
+            cache = None if args.nocache else load_cache(args.dir)
+            with profiler.stage('track'):
+                track_convergence(data, ref, partials, args.metrics,
+                                  args.epsilon, args.jobs, cache, args.tile)
+            if cache is not None:
+                write_cache(args.dir, cache)
+            if args.time_to_error or args.resample or args.downsample:
+                targets = []
+                for target in args.time_to_error or []:
+                    metric, error = target.split('=')
+                    targets.append((metric.lower(), float(error)))
+                process_tracks(data, targets, args.resample, args.downsample)
+    write_data(args.dir, data, args.chunks)
     print('done.')
+    if writer.skipped:
+        print('{} unchanged image(s) not rewritten'.format(writer.skipped))
+
+    if args.profile is not None:
+        profiler.print_summary()
+        if args.profile:
+            trace = profiler.save(args.profile)
+            print('Profile written to: {} ({})'.format(args.profile, trace))
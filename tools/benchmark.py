@@ -0,0 +1,323 @@
+from __future__ import print_function
+
+"""
+A script to benchmark metrics, false color maps, image I/O, convergence
+tracking and full analysis runs on synthetic renders, and to compare the
+results against a baseline.
+"""
+
+import os
+import sys
+import argparse
+import json
+import shutil
+import subprocess as sp
+import tempfile
+import time
+import multiprocessing as mp
+import numpy as np
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+RESOLUTIONS = {'720p': (1280, 720), '1080p': (1920, 1080), '4k': (3840, 2160), '8k': (7680, 4320)}
+STAGES = ['startup', 'metrics', 'falsecolor', 'io', 'track', 'analyze']
+ALGORITHMS = ['pt', 'bdpt']
+# Dependencies which must only be imported on the code paths needing them
+HEAVY_MODULES = ['cv2', 'OpenEXR', 'PIL', 'matplotlib', 'skimage']
+
+
+def synth_reference(width, height, seed=0):
+    """Deterministic HDR image: shaded textured gradient with a few bright highlights."""
+
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 1, width, dtype=np.float32)[np.newaxis, :]
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, np.newaxis]
+    shade = (0.2 + 0.6 * x * (1 - y)) * (0.6 + 0.4 * np.sin(40 * x) * np.cos(25 * y))
+    img = np.empty((height, width, 3), dtype=np.float32)
+    for c, tint in enumerate([1.0, 0.8, 0.6]):
+        img[:, :, c] = shade * tint
+    for _ in range(8):
+        cx, cy = rng.uniform(0, 1, 2)
+        radius, power = rng.uniform(0.01, 0.05), rng.uniform(5, 50)
+        img += (power * np.exp(-((x - cx) ** 2 + (y - cy) ** 2) / radius ** 2))[:, :, np.newaxis]
+    return img
+
+
+def synth_render(ref, spp, seed):
+    """Monte Carlo-like render of ref at spp samples per pixel: unbiased,
+    with relative noise decreasing as 1/sqrt(spp) and a heavy bright tail.
+    """
+
+    rng = np.random.default_rng(seed)
+    noise = rng.gamma(spp / 4.0, 4.0 / spp, ref.shape[:2]).astype(np.float32)
+    return ref * noise[:, :, np.newaxis]
+
+
+def make_scene(work_dir, resolution, partials):
+    """Write (or reuse) a synthetic scene directory for analyze.py -A:
+    Reference.exr and <alg>_partial/ directories with their time files.
+    """
+
+    import pyexr
+
+    scene_dir = os.path.join(work_dir, '{}-{}'.format(resolution, partials))
+    done = os.path.join(scene_dir, '.complete')
+    if os.path.exists(done):
+        return scene_dir
+
+    print('Synthesizing {} scene with {} partials... '.format(resolution, partials))
+    width, height = RESOLUTIONS[resolution]
+    ref = synth_reference(width, height)
+    if not os.path.exists(scene_dir):
+        os.makedirs(scene_dir)
+    pyexr.write(os.path.join(scene_dir, 'Reference.exr'), ref)
+    for a, alg in enumerate(ALGORITHMS):
+        partial_dir = os.path.join(scene_dir, '{}_partial'.format(alg))
+        if not os.path.exists(partial_dir):
+            os.makedirs(partial_dir)
+        times = []
+        for k in range(1, partials + 1):
+            img = synth_render(ref, 4 * 2 ** k, seed=100 * a + k)
+            pyexr.write(os.path.join(partial_dir, '{}_{}.exr'.format(alg, k)), img)
+            times.append(str(10 * k))
+        with open(os.path.join(partial_dir, '{}_time.csv'.format(alg)), 'w') as fp:
+            fp.write(','.join(times))
+    open(done, 'w').close()
+    return scene_dir
+
+
+def peak_rss_mb(rusage):
+    """Peak resident set size of a rusage, in MB (ru_maxrss is in KB on Linux)."""
+
+    scale = 1 << 20 if sys.platform == 'darwin' else 1 << 10
+    return rusage.ru_maxrss * scale / float(1 << 20)
+
+
+def bench_stage(stage, scene_dir, metric, repeat):
+    """Run one stage in this (fresh) process, returning its best time over
+    repeat runs, the number of pixels processed and the process peak RSS.
+    """
+
+    import resource
+    sys.path.insert(0, TOOLS_DIR)
+    import pyexr
+    from metric import compute_metrics, falsecolor, save_png
+    from analyze import load_img, track_convergence, image_cache
+
+    ref_path = os.path.join(scene_dir, 'Reference.exr')
+    ref = load_img(ref_path)
+    test = load_img(os.path.join(scene_dir, 'pt_partial', 'pt_1.exr'))
+    pixels = ref.shape[0] * ref.shape[1]
+    out_dir = tempfile.mkdtemp()
+
+    if stage == 'metric':
+        def run(): compute_metrics(ref, test, [metric], full=False)
+    elif stage == 'metrics':
+        def run(): compute_metrics(ref, test, metric.split('+'))
+    elif stage == 'falsecolor':
+        err = compute_metrics(ref, test, ['mape'])['mape'][0]
+        def run(): falsecolor(err, [0, 1])
+    elif stage == 'png-write':
+        fc = falsecolor(compute_metrics(ref, test, ['mape'])['mape'][0], [0, 1])
+        def run(): save_png(os.path.join(out_dir, 'fc.png'), fc)
+    elif stage == 'exr-read':
+        def run(): load_img(ref_path)
+    elif stage == 'exr-write':
+        def run(): pyexr.write(os.path.join(out_dir, 'out.exr'), test)
+    elif stage == 'track':
+        partial_dirs = [os.path.join(scene_dir, '{}_partial'.format(a)) for a in ALGORITHMS]
+        metrics = metric.split('+')
+        pixels *= sum(len(os.listdir(d)) - 1 for d in partial_dirs)
+        def run():
+            # Start cold, so that every repeat decodes the partial renders
+            image_cache.clear()
+            data = {'stats': [{'series': [{'label': m.upper(), 'track': {'x': [], 'y': []}}
+                                          for m in metrics]}]}
+            track_convergence(data, ref, partial_dirs, metrics)
+    else:
+        raise ValueError('Unknown stage: {}'.format(stage))
+
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        run()
+        times.append(time.time() - start)
+    shutil.rmtree(out_dir)
+    return min(times), pixels, peak_rss_mb(resource.getrusage(resource.RUSAGE_SELF))
+
+
+def bench_process(cmd, repeat, pixels=None):
+    """Time a command run in a child process, with its peak RSS."""
+
+    times, rss = [], 0
+    for _ in range(repeat):
+        start = time.time()
+        proc = sp.Popen(cmd, stdout=sp.DEVNULL)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = status
+        times.append(time.time() - start)
+        rss = max(rss, peak_rss_mb(rusage))
+        if status != 0:
+            raise Exception('Command failed: {}'.format(' '.join(cmd)))
+    return min(times), pixels, rss
+
+
+def heavy_imports(module):
+    """Names of the heavy dependencies loaded by importing a tools module."""
+
+    code = 'import sys; sys.path.insert(0, {!r}); import {}; print(" ".join(m for m in {!r} if m in sys.modules))'
+    out = sp.check_output([sys.executable, '-c', code.format(TOOLS_DIR, module, HEAVY_MODULES)])
+    return out.decode().split()
+
+
+def check_startup(results, budget):
+    """Check that importing the tools is fast and lightweight.
+    Returns the failures, as messages.
+    """
+
+    failures = []
+    for name in sorted(results):
+        if not name.startswith('startup/'):
+            continue
+        if results[name]['seconds'] > budget:
+            failures.append('{} took {:.3f}s, over the {:.3f}s budget'.format(
+                name, results[name]['seconds'], budget))
+        if results[name]['imports']:
+            failures.append('{} imported {}'.format(name, ', '.join(results[name]['imports'])))
+    return failures
+
+
+def run_benchmarks(args):
+    """Run all selected benchmarks, returning {name: result} dictionary."""
+
+    results = {}
+    # Stages run in fresh interpreters, so that peak RSS is per stage
+    ctx = mp.get_context('spawn')
+
+    def record(name, result):
+        seconds, pixels, rss = result
+        results[name] = {'seconds': seconds, 'rss_mb': rss}
+        if pixels:
+            results[name]['mpix_s'] = pixels / seconds / 1e6
+        print('  {:<48} {:>9.3f}s {:>10} {:>9.0f} MB'.format(
+            name, seconds, '{:.1f} MP/s'.format(pixels / seconds / 1e6) if pixels else '', rss))
+
+    if 'startup' in args.stages:
+        for module in ['metric', 'analyze']:
+            cmd = [sys.executable, '-c', 'import sys; sys.path.insert(0, {!r}); import {}'.format(
+                TOOLS_DIR, module)]
+            name = 'startup/import-{}'.format(module)
+            record(name, bench_process(cmd, args.repeat))
+            results[name]['imports'] = heavy_imports(module)
+
+    # Synthetic scenes are not needed to time startup only
+    if set(args.stages) == {'startup'}:
+        return results
+
+    for resolution in args.resolutions:
+        scene_dir = make_scene(args.workdir, resolution, args.partials)
+        width, height = RESOLUTIONS[resolution]
+        print('Benchmarking {} ({}x{})'.format(resolution, width, height))
+
+        jobs = []
+        if 'metrics' in args.stages:
+            jobs += [('metric', m) for m in args.metrics]
+            jobs.append(('metrics', '+'.join(args.metrics)))
+        if 'falsecolor' in args.stages:
+            jobs.append(('falsecolor', None))
+        if 'io' in args.stages:
+            jobs += [('exr-read', None), ('exr-write', None), ('png-write', None)]
+        if 'track' in args.stages:
+            jobs.append(('track', '+'.join(args.metrics)))
+
+        for stage, metric in jobs:
+            with ctx.Pool(1) as pool:
+                result = pool.apply(bench_stage, (stage, scene_dir, metric, args.repeat))
+            # Named after the metrics, so that runs with different ones never compare
+            name = '{}/{}'.format(resolution, stage if metric is None else '{}-{}'.format(stage, metric))
+            record(name, result)
+
+        if 'analyze' in args.stages:
+            viewer_dir = os.path.join(scene_dir, 'viewer')
+            if not os.path.exists(viewer_dir):
+                os.makedirs(viewer_dir)
+            cmd = [sys.executable, os.path.join(TOOLS_DIR, 'analyze.py'), '-A', scene_dir,
+                   '-d', viewer_dir, '-m'] + args.metrics + ['-nc']
+            pixels = width * height * (1 + len(ALGORITHMS) * (args.partials + 1))
+            # Images are only written when their content changed: time full
+            # runs writing everything, then reruns on unchanged images
+            metrics = '+'.join(args.metrics)
+            record('{}/analyze-{}'.format(resolution, metrics),
+                   bench_process(cmd + ['-rw'], args.repeat, pixels))
+            record('{}/analyze-unchanged-{}'.format(resolution, metrics),
+                   bench_process(cmd, args.repeat, pixels))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print the change of each benchmark relative to a baseline.
+    Returns the names of benchmarks slower than baseline by more than tolerance.
+    """
+
+    regressions = []
+    print('{:<48} {:>10} {:>10} {:>8}'.format('Benchmark', 'Baseline', 'Current', 'Change'))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['seconds'], results[name]['seconds']
+        change = new / old - 1
+        flag = ''
+        if change > tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('{:<48} {:>9.3f}s {:>9.3f}s {:>+7.1f}%{}'.format(name, old, new, 100 * change, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    # Parse arguments
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the metric and analysis pipeline.')
+    parser.add_argument('-r',   '--resolutions',
+                        help='image resolutions', nargs='+', choices=sorted(RESOLUTIONS), type=str, default=['1080p'])
+    parser.add_argument('-s',   '--stages',
+                        help='stages to benchmark', nargs='+', choices=STAGES, type=str, default=STAGES)
+    parser.add_argument('-m',   '--metrics',
+                        help='difference metrics', nargs='+',
+                        choices=['l1', 'l2', 'mrse', 'mape', 'smape', 'dssim'], type=str,
+                        default=['l1', 'l2', 'mrse', 'mape', 'smape', 'dssim'])
+    parser.add_argument('-p',   '--partials',
+                        help='partial renders per algorithm', type=int, default=8)
+    parser.add_argument('-n',   '--repeat',
+                        help='runs per benchmark (best time is kept)', type=int, default=3)
+    parser.add_argument('-w',   '--workdir',
+                        help='directory of the synthetic scenes (kept across runs)', type=str,
+                        default=os.path.join(tempfile.gettempdir(), 'viewer-benchmark'))
+    parser.add_argument('-o',   '--output',
+                        help='JSON file to write results to', type=str)
+    parser.add_argument('-b',   '--baseline',
+                        help='JSON results to compare against', type=str)
+    parser.add_argument('-tol', '--tolerance',
+                        help='relative slowdown reported as a regression', type=float, default=0.1)
+    parser.add_argument('-sb',  '--startup-budget',
+                        help='maximum time to import metric.py or analyze.py (s)', type=float, default=0.5)
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=4, sort_keys=True)
+
+    failed = False
+    for failure in check_startup(results, args.startup_budget):
+        print('Startup: {}'.format(failure))
+        failed = True
+
+    if args.baseline:
+        with open(args.baseline, 'r') as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('{} regression(s) over {:.0%}'.format(len(regressions), args.tolerance))
+            failed = True
+    if failed:
+        sys.exit(1)
@@ -6,68 +6,801 @@ and generate false color heatmap visualizations.
 """
 
 import argparse
-import pyexr
+import csv
+import json
+import os
+import hashlib
+import sys
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
 import numpy as np
-import matplotlib.pyplot as plt
-from PIL import Image
-from mpl_toolkits.axes_grid1 import make_axes_locatable
-from skimage.measure import compare_ssim, compare_psnr
+# Heavy dependencies (matplotlib, PIL, OpenEXR) are imported lazily,
+# only on the code paths needing them, to keep startup time low
 COLOR_MAP = 'viridis'
+# Matplotlib's 256-entry viridis colormap, as 8-bit RGB triplets
+COLOR_LUT = np.frombuffer(bytes.fromhex(
+    '44015444025544035745055845065a45085b46095c460b5e460c5f460e61470f62471163'
+    '47126547146647156747166947186a48196b481a6c481c6e481d6f481e70482071482172'
+    '482273482374472575472676472777472878472a79472b7a472c7b462d7c462f7c46307d'
+    '46317e45327f45347f453580453681443781443982433a83433b83433c84423d84423e85'
+    '4240854141864142864043874044873f45873f47883e48883e49893d4a893d4b893d4c89'
+    '3c4d8a3c4e8a3b508a3b518a3a528b3a538b39548b39558b38568b38578c37588c37598c'
+    '365a8c365b8c355c8c355d8c345e8d345f8d33608d33618d32628d32638d31648d31658d'
+    '31668d30678d30688d2f698d2f6a8d2e6b8e2e6c8e2e6d8e2d6e8e2d6f8e2c708e2c718e'
+    '2c728e2b738e2b748e2a758e2a768e2a778e29788e29798e287a8e287a8e287b8e277c8e'
+    '277d8e277e8e267f8e26808e26818e25828e25838d24848d24858d24868d23878d23888d'
+    '23898d22898d228a8d228b8d218c8d218d8c218e8c208f8c20908c20918c1f928c1f938b'
+    '1f948b1f958b1f968b1e978a1e988a1e998a1e998a1e9a891e9b891e9c891e9d881e9e88'
+    '1e9f881ea0871fa1871fa2861fa38620a48520a58521a68521a78422a78423a88323a982'
+    '24aa8225ab8126ac8127ad8028ae7f29af7f2ab07e2bb17d2cb17d2eb27c2fb37b30b47a'
+    '32b57a33b67935b77836b87738b97639b9763bba753dbb743ebc7340bd7242be7144be70'
+    '45bf6f47c06e49c16d4bc26c4dc26b4fc36951c46853c56755c66657c66559c7645bc862'
+    '5ec96160c96062ca5f64cb5d67cc5c69cc5b6bcd596dce5870ce5672cf5574d05477d052'
+    '79d1517cd24f7ed24e81d34c83d34b86d44988d5478bd5468dd64490d64392d74195d73f'
+    '97d83e9ad83c9dd93a9fd938a2da37a5da35a7db33aadb32addc30afdc2eb2dd2cb5dd2b'
+    'b7dd29bade27bdde26bfdf24c2df22c5df21c7e01fcae01ecde01dcfe11cd2e11bd4e11a'
+    'd7e219dae218dce218dfe318e1e318e4e318e7e419e9e419ece41aeee51bf1e51cf3e51e'
+    'f6e61ff8e621fae622fde724'), dtype=np.uint8).reshape(256, 3)
+METRICS = ['l1', 'l2', 'mrse', 'mape', 'smape', 'dssim']
+# SSIM window size, and extra rows needed above/below a block of rows
+# so that all windows centered in the block are exact
+SSIM_WIN = 7
+SSIM_HALO = SSIM_WIN // 2
 
 
-def compute_metric(ref, test, metric, eps=1e-2):
+def window_sum(img, size, axis):
+    """Sums over windows of size consecutive elements along an axis (valid
+    part only), accumulated from power-of-two windows with shifted additions.
+    """
+
+    def sl(start, stop):
+        return (slice(None),) * axis + (slice(start, stop),)
+
+    n = img.shape[axis] - size + 1
+    out, offset = None, 0
+    acc, width = img, 1
+    while True:
+        if size & width:
+            part = acc[sl(offset, offset + n)]
+            out = part.copy() if out is None else out + part
+            offset += width
+        if 2 * width > size:
+            return out
+        acc = acc[sl(None, -width)] + acc[sl(width, None)]
+        width *= 2
+
+
+def ssim_block(ref, test, data_range=255):
+    """SSIM map of one padded (C, H, W) block (see ssim)."""
+
+    K1, K2 = 0.01, 0.03
+    N = SSIM_WIN ** 2
+    C1 = (K1 * data_range) ** 2 * N * N
+    C2 = (K2 * data_range) ** 2 * N * (N - 1)
+
+    def box(img):
+        return window_sum(window_sum(img, SSIM_WIN, 1), SSIM_WIN, 2)
+
+    # Using window sums instead of means, the normalizations of the means
+    # and sample (co)variances cancel out; all terms but the constants are
+    # then exact integers for 8-bit images
+    sx, sy = box(ref), box(test)
+    sxx, syy, sxy = box(ref * ref), box(test * test), box(ref * test)
+    sxsy = sx * sy
+    num = (2 * sxsy + C1) * (2 * (N * sxy - sxsy) + C2)
+    sx *= sx
+    sy *= sy
+    den = (sx + sy + C1) * (N * (sxx + syy) - sx - sy + C2)
+    num /= den
+    return num
+
+
+def ssim(ref, test, data_range=255, full=True, rows=256, workers=None):
+    """Structural similarity of two (H, W, C) images, matching skimage's
+    compare_ssim(multichannel=True, full=True) with its default uniform 7x7
+    window, sample covariance and reflected borders. Window sums are computed
+    with shifted additions, over blocks of rows evaluated on a thread pool.
+    Returns the SSIM map, or only its mean if full is False.
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    # 8-bit images are filtered exactly in int32 (sums cannot overflow)
+    dtype = np.int32 if ref.dtype == np.uint8 else np.float64
+    height = ref.shape[0]
+    S = np.empty(ref.shape) if full else None
+
+    def run(block):
+        y0, y1 = block
+        h0, h1 = max(y0 - SSIM_HALO, 0), min(y1 + SSIM_HALO, height)
+        pad = ((0, 0), (SSIM_HALO - (y0 - h0), SSIM_HALO - (h1 - y1)),
+               (SSIM_HALO, SSIM_HALO))
+
+        # Channels are filtered as contiguous planes
+        x = np.ascontiguousarray(np.moveaxis(ref[h0:h1], -1, 0), dtype=dtype)
+        y = np.ascontiguousarray(np.moveaxis(test[h0:h1], -1, 0), dtype=dtype)
+        sb = ssim_block(np.pad(x, pad, 'symmetric'),
+                        np.pad(y, pad, 'symmetric'), data_range)
+        if full:
+            S[y0:y1] = np.moveaxis(sb, 0, -1)
+        return np.sum(sb)
+
+    with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+        total = sum(pool.map(run, row_blocks(height, rows, SSIM_HALO)))
+    return S if full else total / ref.size
+
+
+def tonemap(img, gamma=2.2):
+    """Gamma tonemapping of an HDR image to [0, 1] (same as pyexr.tonemap)."""
+
+    return np.clip(img ** (1.0 / gamma), 0, 1)
+
+
+def compute_metric(ref, test, metric, eps=1e-2, dtype=None):
     """Compute desired metric."""
-    diff = np.array(ref - test)
-    
-    if (metric == 'l1'):      # Absolute error
-        error = np.abs(diff)
-    elif (metric == 'l2'):    # Squared error
-        error = diff * diff
-    elif (metric == 'mrse'):  # Relative squared error
-        error = diff * diff / (ref * ref + eps)
-    elif (metric == 'mape'):  # Relative absolute error
-        error = np.abs(diff) / (ref + eps)
-    elif (metric == 'smape'):  # Symmetric absolute error
-        error = 2 * np.abs(diff) / (ref + test + eps)
-    elif (metric == 'dssim'):
-        # Tonemap the images before SSIM
-        ref_tonemap = np.array(pyexr.tonemap(ref) * 255, dtype=np.uint8)
-        test_tonemap = np.array(pyexr.tonemap(test) * 255, dtype=np.uint8)
-        error = 1.0 - compare_ssim(ref_tonemap,
-                                   test_tonemap,
-                                   multichannel=True,
-                                   full=True)[1]
-    else:
-        raise ValueError('Invalid metric')
 
-    return error
+    return compute_metrics(ref, test, [metric], eps, dtype)[metric][0]
+
+
+def compute_metrics(ref, test, metrics, eps=1e-2, dtype=None, full=True):
+    """Compute several metrics from a single shared difference pass.
+    Returns a dictionary mapping each metric to its (error image, mean) pair.
+    Error images are computed in dtype (by default, the floating point type
+    of the inputs) but means are always accumulated in float64.
+    If full is False, the DSSIM error image is skipped (None) and only its
+    mean is computed.
+    """
+
+    for metric in metrics:
+        if metric.lower() not in METRICS:
+            raise ValueError('Invalid metric')
+
+    # Shared difference buffers, only allocated if some metric needs them
+    names = [metric.lower() for metric in metrics]
+    if dtype is None:
+        dtype = np.result_type(ref, test, np.float32)
+    diff_sq, diff_abs = None, None
+    if any(m in ['l1', 'l2', 'mrse', 'mape', 'smape'] for m in names):
+        with profiler.stage('metric/diff', ref.nbytes):
+            diff = np.subtract(ref, test, dtype=dtype)
+            if any(m in ['l2', 'mrse'] for m in names):
+                diff_sq = np.multiply(diff, diff)
+            if any(m in ['l1', 'mape', 'smape'] for m in names):
+                diff_abs = np.abs(diff, out=diff)
+
+    results = {}
+    for metric, name in zip(metrics, names):
+        with profiler.stage('metric/' + name, ref.nbytes):
+            if (name == 'l1'):      # Absolute error
+                error = diff_abs
+            elif (name == 'l2'):    # Squared error
+                error = diff_sq
+            elif (name == 'mrse'):  # Relative squared error
+                error = np.multiply(ref, ref, dtype=dtype)
+                error += eps
+                np.divide(diff_sq, error, out=error)
+            elif (name == 'mape'):  # Relative absolute error
+                error = np.add(ref, eps, dtype=dtype)
+                np.divide(diff_abs, error, out=error)
+            elif (name == 'smape'):  # Symmetric absolute error
+                error = np.add(ref, test, dtype=dtype)
+                error += eps
+                np.divide(diff_abs, error, out=error)
+                error *= 2
+            elif (name == 'dssim'):
+                # Tonemap the images before SSIM
+                ref_tonemap = np.array(tonemap(ref) * 255, dtype=np.uint8)
+                test_tonemap = np.array(tonemap(test) * 255, dtype=np.uint8)
+                if not full:
+                    results[metric] = (None, 1.0 - ssim(ref_tonemap, test_tonemap, full=False))
+                    continue
+                error = 1.0 - ssim(ref_tonemap, test_tonemap)
+            results[metric] = (error, np.mean(error, dtype=np.float64))
+
+    return results
 
 
 def falsecolor(error, clip, eps=1e-2):
-    """Compute false color heatmap."""
+    """Compute false color heatmap (8-bit RGB) with a colormap lookup table."""
 
-    cmap = plt.get_cmap(COLOR_MAP)
-    mean = np.mean(error, axis=2)
-    min_val, max_val = clip
-    val = np.clip((mean - min_val) / (max_val - min_val + eps), 0, 1)
-    return cmap(val)
+    with profiler.stage('falsecolor', error.nbytes):
+        min_val, max_val = clip
+        val = np.mean(error, axis=2)
+        val -= min_val
+        val /= max_val - min_val + eps
+        val *= len(COLOR_LUT)
+
+        # Same binning as matplotlib: [0, 1] split in N bins, 1 in the last one
+        np.clip(val, 0, len(COLOR_LUT) - 1, out=val)
+        np.nan_to_num(val, copy=False)
+        return COLOR_LUT[val.astype(np.intp)]
 
 
 def falsecolor_np(ref, test, eps=1e-2):
     """Compute negative / positive relative error."""
-    diff = 2 * np.array(test - ref) / (ref + test + eps)
-    diff = np.mean(diff, axis=2)
-    diff = np.clip(diff, -1, 1)
+    with profiler.stage('falsecolor/np', ref.nbytes):
+        diff = 2 * np.array(test - ref) / (ref + test + eps)
+        diff = np.mean(diff, axis=2)
+        diff = np.clip(diff, -1, 1)
+
+        img = np.zeros((diff.shape[0], diff.shape[1], 3), dtype=diff.dtype)
+        img[diff > 0, 0] = diff[diff > 0]
+        img[diff < 0, 1] = -diff[diff < 0]
+        return img
+
+
+class RowReader(object):
+    """Read an image by blocks of rows.
+    OpenEXR files are decoded scanline by scanline; arrays are simply sliced.
+    """
+
+    def __init__(self, src, dtype=np.float32):
+        self.dtype = dtype
+        if not isinstance(src, np.ndarray):
+            sidecar = load_sidecar(src)
+            if sidecar is not None:
+                src = sidecar
+        if isinstance(src, np.ndarray):
+            self.img = src
+            self.height, self.width = src.shape[:2]
+        else:
+            import OpenEXR
+            self.img = None
+            self.fp = OpenEXR.InputFile(src)
+            header = self.fp.header()
+            dw = header['dataWindow']
+            self.y_min = dw.min.y
+            self.height = dw.max.y - dw.min.y + 1
+            self.width = dw.max.x - dw.min.x + 1
+
+            # Same channels as pyexr's default group, i.e. root RGBA first
+            channels = [c for c in header['channels'] if '.' not in c]
+            rgba = [c for c in 'RGBA' if c in channels]
+            self.channels = rgba + sorted(set(channels) - set(rgba))
+
+    def read(self, y0, y1):
+        """Read rows [y0, y1) as an array."""
+
+        if self.img is not None:
+            return np.asarray(self.img[y0:y1], dtype=self.dtype)
+
+        import Imath
+        pt = Imath.PixelType(Imath.PixelType.FLOAT)
+        raw = self.fp.channels(self.channels, pt,
+                               self.y_min + y0, self.y_min + y1 - 1)
+        block = np.empty((y1 - y0, self.width, len(self.channels)), dtype=self.dtype)
+        for c, buf in enumerate(raw):
+            block[:, :, c] = np.frombuffer(buf, dtype=np.float32).reshape(
+                y1 - y0, self.width)
+        return block
+
+
+class RunningStats(object):
+    """Running mean/variance/min/max over blocks, merged with Chan et al.'s
+    pairwise update to stay numerically stable over many blocks.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, block):
+        """Accumulate all elements of block."""
+
+        n = block.size
+        if n == 0:
+            return
+        mean = np.mean(block, dtype=np.float64)
+        m2 = np.sum(np.square(block - mean), dtype=np.float64)
+        delta = mean - self.mean
+        total = self.n + n
+        self.mean += delta * n / total
+        self.m2 += m2 + delta * delta * self.n * n / total
+        self.n = total
+        self.min = min(self.min, np.amin(block))
+        self.max = max(self.max, np.amax(block))
+
+    @property
+    def var(self):
+        return self.m2 / self.n if self.n else 0.0
+
+
+class PNGWriter(object):
+    """Write an 8-bit RGB(A) PNG image incrementally, one block of rows at a time."""
+
+    def __init__(self, fname, width, height, channels=4):
+        self.fp = open(fname, 'wb')
+        self.z = zlib.compressobj()
+        color_type = {3: 2, 4: 6}[channels]
+        self.fp.write(b'\x89PNG\r\n\x1a\n')
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height,
+                                         8, color_type, 0, 0, 0))
+
+    def _chunk(self, tag, data):
+        self.fp.write(struct.pack('>I', len(data)))
+        self.fp.write(tag + data)
+        self.fp.write(struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+    def write(self, rows):
+        """Append rows (uint8 array of shape h x w x channels)."""
+
+        # Each scanline is prefixed with filter type 0 (none)
+        lines = np.zeros((rows.shape[0], rows.shape[1] * rows.shape[2] + 1),
+                         dtype=np.uint8)
+        lines[:, 1:] = rows.reshape(rows.shape[0], -1)
+        data = self.z.compress(lines.tobytes())
+        if data:
+            self._chunk(b'IDAT', data)
+
+    def close(self):
+        self._chunk(b'IDAT', self.z.flush())
+        self._chunk(b'IEND', b'')
+        self.fp.close()
+
+
+def row_blocks(height, rows, min_rows=1):
+    """Split [0, height) into blocks of rows, each at least min_rows high."""
+
+    rows = max(rows, min_rows)
+    blocks = [[y0, min(y0 + rows, height)] for y0 in range(0, height, rows)]
+    if len(blocks) > 1 and blocks[-1][1] - blocks[-1][0] < min_rows:
+        last = blocks.pop()
+        blocks[-1][1] = last[1]
+    return blocks
+
+
+def compute_metrics_tiled(ref, test, metrics, eps=1e-2, rows=256,
+                          clip=None, fc_paths=None, dtype=np.float32):
+    """Compute metrics by blocks of rows, so that peak memory is bounded
+    by the block size. Images are either arrays or OpenEXR filenames.
+    Returns running statistics of each error image; false color heatmaps
+    are streamed to fc_paths[metric] if given.
+    """
+
+    ref, test = RowReader(ref, dtype), RowReader(test, dtype)
+    if (ref.height, ref.width) != (test.height, test.width):
+        raise ValueError('Reference and test images must have the same size')
+    fc_paths = fc_paths or {}
+    stats = dict((metric, RunningStats()) for metric in metrics)
+    writers = dict((metric, PNGWriter(fc_paths[metric], ref.width, ref.height, 3))
+                   for metric in metrics if metric in fc_paths)
+
+    halo = SSIM_HALO if any(m.lower() == 'dssim' for m in metrics) else 0
+    for y0, y1 in row_blocks(ref.height, rows, 2 * halo + 1):
+        h0, h1 = max(y0 - halo, 0), min(y1 + halo, ref.height)
+        errors = compute_metrics(ref.read(h0, h1), test.read(h0, h1),
+                                 metrics, eps, dtype)
+        for metric in metrics:
+            error = errors[metric][0][y0 - h0:y1 - h0]
+            stats[metric].update(error)
+            if metric in writers:
+                writers[metric].write(falsecolor(error, clip, eps))
+
+    for writer in writers.values():
+        writer.close()
+    return stats
+
+
+def falsecolor_np_tiled(ref, test, fname, eps=1e-2, rows=256, dtype=np.float32):
+    """Stream negative / positive relative error image by blocks of rows."""
+
+    ref, test = RowReader(ref, dtype), RowReader(test, dtype)
+    writer = PNGWriter(fname, ref.width, ref.height, channels=3)
+    for y0, y1 in row_blocks(ref.height, rows):
+        fc = falsecolor_np(ref.read(y0, y1), test.read(y0, y1), eps)
+        writer.write((fc * 255).astype(np.uint8))
+    writer.close()
+
+
+def load_exr(fname, dtype=np.float32):
+    """Load OpenEXR image as an array (memory-mapped if it has a sidecar)."""
+
+    with profiler.stage('decode', file=os.path.basename(fname)) as stage:
+        img = load_sidecar(fname)
+        if img is None:
+            import pyexr
+            img = pyexr.open(fname).get()
+        img = np.asarray(img, dtype=dtype)
+        stage.count(img.nbytes)
+        return img
+
+
+def file_hash(fname):
+    """SHA-1 of file content."""
+
+    h = hashlib.sha1()
+    with open(fname, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def atomic_write(fname, text):
+    """Write text file through a temporary file renamed over it, so that
+    readers never see a partially written file.
+    """
+
+    with profiler.stage('write', len(text), file=os.path.basename(fname)):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)),
+                                   prefix='.' + os.path.basename(fname))
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                fp.write(text)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, fname)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+
+def atomic_save(fname, img):
+    """Save array as a .npy file through a temporary file renamed over it."""
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)),
+                               prefix='.' + os.path.basename(fname))
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            np.save(fp, img)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, fname)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
 
-    img = np.zeros((diff.shape[0], diff.shape[1], 3))
-    img[diff > 0, 0] = diff[diff > 0]
-    img[diff < 0, 1] = -diff[diff < 0]
-    return img
+def load_sidecar(fname):
+    """Memory-map the .npy sidecar of an image, or return None if it is
+    missing or stale (source content changed since conversion).
+    """
+
+    npy_path, meta_path = fname + '.npy', fname + '.npy.json'
+    if not os.path.exists(npy_path) or not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r') as fp:
+        meta = json.load(fp)
+
+    # Only rehash the source if its stamp changed (e.g. touched or copied)
+    st = os.stat(fname)
+    if [st.st_mtime, st.st_size] != [meta['mtime'], meta['size']]:
+        if file_hash(fname) != meta['sha1']:
+            return None
+        meta['mtime'], meta['size'] = st.st_mtime, st.st_size
+        atomic_write(meta_path, json.dumps(meta))
+    return np.load(npy_path, mmap_mode='r')
+
+
+def make_sidecar(fname):
+    """Convert an OpenEXR image to a raw float32 .npy sidecar next to it,
+    unless an up-to-date one exists. Returns the memory-mapped image.
+    """
+
+    img = load_sidecar(fname)
+    if img is not None:
+        return img
+
+    import pyexr
+
+    # Both files are written atomically, data first, so that concurrent
+    # readers never see a partial sidecar or metadata without data
+    npy_path, meta_path = fname + '.npy', fname + '.npy.json'
+    st = os.stat(fname)
+    meta = {'sha1': file_hash(fname), 'mtime': st.st_mtime, 'size': st.st_size}
+    atomic_save(npy_path, np.asarray(pyexr.open(fname).get(), dtype=np.float32))
+    atomic_write(meta_path, json.dumps(meta))
+    return np.load(npy_path, mmap_mode='r')
+
+
+class ImageCache(object):
+    """Least recently used cache of decoded images, bounded in bytes.
+    Entries are keyed on filename, modification time and loader arguments.
+    If spill_dir is given, evicted images are saved there as .npy files and
+    memory-mapped back when requested again (also by later processes).
+    Safe to share between threads.
+    """
+
+    def __init__(self, loader, max_bytes=2 << 30, spill_dir=None):
+        self.lock = threading.Lock()
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+    def clear(self):
+        """Drop all cached images (spilled ones are kept)."""
+
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def _spill_path(self, key):
+        name = hashlib.sha1(repr(key).encode('utf8')).hexdigest()
+        return os.path.join(self.spill_dir, '{}.npy'.format(name))
+
+    def get(self, fname, *args):
+        """Return decoded image, loading it with loader(fname, *args) on a miss.
+        Images are decoded outside of the lock, so that threads missing on
+        different images decode them concurrently.
+        """
+
+        key = (os.path.abspath(fname), os.path.getmtime(fname)) + args
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        if self.spill_dir and os.path.exists(self._spill_path(key)):
+            img = np.load(self._spill_path(key), mmap_mode='r')
+        else:
+            img = self.loader(fname, *args)
+
+        evicted = []
+        with self.lock:
+            # Another thread may have loaded the same image meanwhile
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.entries[key] = img
+            self.nbytes += img.nbytes
+            while self.nbytes > self.max_bytes and len(self.entries) > 1:
+                old_key, old = self.entries.popitem(last=False)
+                self.nbytes -= old.nbytes
+                evicted.append((old_key, old))
+
+        for old_key, old in evicted:
+            if self.spill_dir and not isinstance(old, np.memmap):
+                self._spill(old_key, old)
+        return img
+
+    def _spill(self, key, img):
+        # Written atomically: other threads may load it meanwhile
+        os.makedirs(self.spill_dir, exist_ok=True)
+        atomic_save(self._spill_path(key), img)
+
+
+class NullStage(object):
+    """Stage of a disabled profiler: does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def count(self, nbytes):
+        pass
+
+
+class ProfileStage(object):
+    """Time one run of a stage; bytes processed can be added with count()."""
+
+    def __init__(self, profiler, name, nbytes, args):
+        self.profiler = profiler
+        self.name = name
+        self.nbytes = nbytes
+        self.args = args
+
+    def __enter__(self):
+        # Nested stages inherit the arguments (e.g. image) of enclosing ones
+        stack = self.profiler.stack()
+        if stack:
+            self.args = dict(stack[-1].args, **self.args)
+        stack.append(self)
+        self.cpu = time.thread_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.start
+        cpu = time.thread_time() - self.cpu
+        self.profiler.stack().pop()
+        self.profiler.record(self.name, self.start, wall, cpu, self.nbytes, self.args)
+
+    def count(self, nbytes):
+        self.nbytes += nbytes
+
+
+class Profiler(object):
+    """Record wall time, CPU time (of the calling thread) and bytes processed
+    by named stages of a run, e.g. with profiler.stage('decode', image=name).
+    Disabled by default, in which case stage() returns a shared no-op
+    context. Stages run in worker processes are not recorded.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.events = []
+        self.origin = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+        self.origin = time.perf_counter()
+
+    def stage(self, name, nbytes=0, **args):
+        if not self.enabled:
+            return NULL_STAGE
+        return ProfileStage(self, name, nbytes, args)
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def record(self, name, start, wall, cpu, nbytes=0, args=None):
+        thread = threading.current_thread()
+        with self.lock:
+            self.events.append({'name': name, 'start': start - self.origin, 'wall': wall,
+                                'cpu': cpu, 'bytes': nbytes, 'tid': thread.ident,
+                                'thread': thread.name, 'args': args or {}})
+
+    def summary(self, key=None):
+        """Totals (count, wall, cpu, bytes) per stage name, for events with
+        a key argument, per value of that argument (e.g. per image).
+        Nested stages are also counted in their enclosing stages.
+        """
+
+        totals = OrderedDict()
+        for event in sorted(self.events, key=lambda e: e['start']):
+            if key is not None:
+                if key not in event['args']:
+                    continue
+                group = totals.setdefault(str(event['args'][key]), OrderedDict())
+            else:
+                group = totals
+            total = group.setdefault(event['name'], {'count': 0, 'wall': 0.0,
+                                                     'cpu': 0.0, 'bytes': 0})
+            total['count'] += 1
+            total['wall'] += event['wall']
+            total['cpu'] += event['cpu']
+            total['bytes'] += event['bytes']
+        return totals
+
+    def print_summary(self):
+        """Print a table of time and throughput per stage."""
+
+        elapsed = time.perf_counter() - self.origin
+        print('{:<24} {:>7} {:>10} {:>10} {:>6} {:>10} {:>9}'.format(
+            'Stage', 'Count', 'Wall (s)', 'CPU (s)', '%', 'MB', 'MB/s'))
+        for name, total in sorted(self.summary().items(), key=lambda t: -t[1]['wall']):
+            mb = total['bytes'] / float(1 << 20)
+            print('{:<24} {:>7} {:>10.3f} {:>10.3f} {:>6.1f} {:>10.1f} {:>9}'.format(
+                name, total['count'], total['wall'], total['cpu'],
+                100 * total['wall'] / elapsed, mb,
+                '{:.1f}'.format(mb / total['wall']) if mb and total['wall'] else '-'))
+        print('{:<24} {:>7} {:>10.3f}'.format('Total', '', elapsed))
+
+    def save(self, fname):
+        """Write the JSON report to fname, and a Chrome trace (chrome://tracing
+        or Perfetto) of all events next to it, as <fname>.trace.json.
+        """
+
+        report = {'wall': time.perf_counter() - self.origin, 'stages': self.summary(),
+                  'images': self.summary('image'), 'events': self.events}
+        with open(fname, 'w') as fp:
+            json.dump(report, fp, indent=4)
+
+        pid = os.getpid()
+        trace = []
+        for tid, name in sorted(set((e['tid'], e['thread']) for e in self.events)):
+            trace.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                          'args': {'name': name}})
+        for event in self.events:
+            trace.append({'name': event['name'], 'cat': event['name'].split('/')[0],
+                          'ph': 'X', 'pid': pid, 'tid': event['tid'],
+                          'ts': event['start'] * 1e6, 'dur': event['wall'] * 1e6,
+                          'args': dict(event['args'], cpu=event['cpu'], bytes=event['bytes'])})
+        trace_fname = '{}.trace.json'.format(os.path.splitext(fname)[0])
+        with open(trace_fname, 'w') as fp:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, fp)
+        return trace_fname
+
+
+NULL_STAGE = NullStage()
+# Stage profiler shared by all modules of a run (see Profiler.enable)
+profiler = Profiler()
+
+
+def parse_request(line, defaults):
+    """Parse batch request, either a JSON object or a CSV row
+    (ref, test, space-separated metrics, epsilon).
+    """
+
+    if line.startswith('{'):
+        req = json.loads(line)
+    else:
+        fields = next(csv.reader([line]))
+        req = dict(zip(['ref', 'test', 'metrics', 'eps'], fields))
+        if 'eps' in req:
+            req['eps'] = float(req['eps'])
+    metrics = req.get('metrics') or req.get('metric') or defaults['metrics']
+    if isinstance(metrics, str):
+        metrics = metrics.split()
+    if not metrics:
+        raise ValueError('No metric requested')
+    return req['ref'], req['test'], metrics, req.get('eps', defaults['eps'])
+
+
+def run_batch(lines, write, cache, defaults, dtype=np.float32):
+    """Process batch requests, writing one JSON result line per request.
+    References are kept decoded in cache between requests.
+    """
+
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#') or line.startswith('ref,'):
+            continue
+        try:
+            ref_fname, test_fname, metrics, eps = parse_request(line, defaults)
+            ref = cache.get(ref_fname, dtype)
+            test = load_exr(test_fname, dtype)
+            errors = compute_metrics(ref, test, metrics, eps, full=False)
+            result = {'ref': ref_fname, 'test': test_fname, 'eps': eps,
+                      'metrics': dict((m, float(errors[m][1])) for m in metrics)}
+        except Exception as e:
+            result = {'request': line, 'error': str(e)}
+        write(json.dumps(result) + '\n')
+
+
+def serve(sock_path, cache, defaults, dtype=np.float32):
+    """Serve batch requests over a Unix socket until interrupted or terminated."""
+
+    import signal
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            def write(txt):
+                self.wfile.write(txt.encode('utf8'))
+                self.wfile.flush()
+            lines = (line.decode('utf8') for line in self.rfile)
+            run_batch(lines, write, cache, defaults, dtype)
+
+    if os.path.exists(sock_path):
+        os.remove(sock_path)
+    server = socketserver.UnixStreamServer(sock_path, Handler)
+    print('Serving metrics on: {}'.format(sock_path))
+
+    # Exit through the finally clause on SIGTERM too, removing the socket
+    # (server.shutdown() would deadlock, called from the serving thread)
+    def terminate(signum, frame):
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(sock_path)
+
+
+def save_png(fname, img):
+    """Save 8-bit or [0, 1] floating point RGB(A) image as PNG."""
+
+    from PIL import Image
+
+    with profiler.stage('png', file=os.path.basename(fname)) as stage:
+        if img.dtype != np.uint8:
+            img = (img * 255).astype(np.uint8)
+        Image.fromarray(img).save(fname)
+        stage.count(img.nbytes)
 
 
 def plot(img, clip, fname):
     """Plot false color heatmap with colorbar legend."""
 
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.axes_grid1 import make_axes_locatable
+
     plt.rcParams.update({'font.size': 18})
     plt.rcParams.update({'font.family': 'linux biolinum'})
 
@@ -95,11 +828,11 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Compute metric between two OpenEXR images.')
     parser.add_argument('-r',   '--ref',
-                        help='reference image filename', type=str, required=True)
+                        help='reference image filename', type=str)
     parser.add_argument('-t',   '--test',
-                        help='test image filename', type=str, required=True)
+                        help='test image filename', type=str)
     parser.add_argument('-m',   '--metric', help='difference metric',
-                        choices=['l1', 'l2', 'rse', 'mape', 'smape', 'dssim'], type=str)
+                        choices=METRICS, type=str)
     parser.add_argument('-eps', '--epsilon',
                         help='epsilon value', type=float, default=1e-2)
     parser.add_argument('-c',   '--clip', 
@@ -112,47 +845,94 @@ if __name__ == '__main__':
                         help='output error as plain text', action='store_true')
     parser.add_argument('-np', '--negpos', type=str,
                         help='positive negative smape output image')
+    parser.add_argument('-tl', '--tile', type=int,
+                        help='stream images by blocks of N rows to bound memory')
+    parser.add_argument('-dt', '--dtype', choices=['float32', 'float64'], default='float32',
+                        help='floating point precision of images and error maps')
+    parser.add_argument('-sc', '--sidecar', action='store_true',
+                        help='convert reference to a memory-mapped .npy sidecar (reused by later runs)')
+    parser.add_argument('-b',  '--batch', type=str,
+                        help='batch requests file (JSONL or CSV, - for stdin); results written as JSONL')
+    parser.add_argument('-s',  '--serve', type=str,
+                        help='serve batch requests on a Unix socket')
 
     args = parser.parse_args()
 
+    # Batch mode: one JSON result per request, references decoded only once
+    if args.batch or args.serve:
+        defaults = {'metrics': [args.metric] if args.metric else [],
+                    'eps': args.epsilon}
+        cache = ImageCache(load_exr)
+        if args.serve:
+            serve(args.serve, cache, defaults, np.dtype(args.dtype))
+        else:
+            def write(txt):
+                sys.stdout.write(txt)
+                sys.stdout.flush()
+            fp = sys.stdin if args.batch == '-' else open(args.batch, 'r')
+            run_batch(fp, write, cache, defaults, np.dtype(args.dtype))
+        sys.exit(0)
+
+    if not args.ref or not args.test:
+        parser.error('--ref and --test are required outside of batch mode')
+
     # Check image formats
     if not args.ref.lower().endswith('.exr') and not args.test.lower().endswith('.exr'):
         raise ValueError('Images must be in OpenEXR format.')
 
-    # Load images and convert to NumPy array
-    try:
-        ref_fp = pyexr.open(args.ref)
-        test_fp = pyexr.open(args.test)
-    except FileNotFoundError:
-        print('Could not open files')
-    ref = np.array(ref_fp.get())
-    test = np.array(test_fp.get())
+    if args.sidecar:
+        make_sidecar(args.ref)
+
+    # Load images and convert to NumPy array (streaming mode reads them by blocks)
+    if not args.tile:
+        try:
+            ref = load_exr(args.ref, args.dtype)
+            test = load_exr(args.test, args.dtype)
+        except FileNotFoundError:
+            print('Could not open files')
 
     # Compute metric
     if args.metric:
-        err_img = compute_metric(ref, test, args.metric, args.epsilon)
-        err_mean = np.mean(err_img)
+        if args.falsecolor and not args.falsecolor.lower().endswith('.png'):
+            raise ValueError(
+                'False color output file must be in PNG format.')
+        if args.tile:
+            fc_paths = {args.metric: args.falsecolor} if args.falsecolor else None
+            stats = compute_metrics_tiled(args.ref, args.test, [args.metric],
+                                          args.epsilon, args.tile, args.clip, fc_paths,
+                                          np.dtype(args.dtype))
+            err_mean = stats[args.metric].mean
+        else:
+            err_img = compute_metric(ref, test, args.metric, args.epsilon)
+            err_mean = np.mean(err_img, dtype=np.float64)
         if args.plain:
             print('{:.6f}'.format(err_mean))
         else:
-            err_min, err_max, err_var = np.amin(
-                err_img), np.amax(err_img), np.var(err_img)
+            if args.tile:
+                err_min, err_max, err_var = stats[args.metric].min, \
+                    stats[args.metric].max, stats[args.metric].var
+            else:
+                err_min, err_max, err_var = np.amin(err_img), np.amax(
+                    err_img), np.var(err_img, dtype=np.float64)
             print('{} = {:.4f} (Min = {:.4f}, Max = {:.4f}, Var = {:.4f})'.format(
                 args.metric.upper(), err_mean, err_min, err_max, err_var))
 
         # Compute false color heatmap
         if (args.falsecolor):
-            if not args.falsecolor.lower().endswith('.png'):
-                raise ValueError(
-                    'False color output file must be in PNG format.')
             if args.clip != [0, 1]:
                 print('Clipping values in range: [{:.2f}, {:.2f}]'.format(
                     args.clip[0], args.clip[1]))
-            fc = falsecolor(err_img, args.clip, args.epsilon)
-            plt.imsave(args.falsecolor, fc)
+            if args.tile:
+                fc = None
+            else:
+                fc = falsecolor(err_img, args.clip, args.epsilon)
+                save_png(args.falsecolor, fc)
             print('False color heatmap written to: {}'.format(args.falsecolor))
             if args.colorbar:
                 fname = args.falsecolor.replace('.png', '.pdf')
+                if fc is None:
+                    import matplotlib.pyplot as plt
+                    fc = plt.imread(args.falsecolor)
                 plot(fc, args.clip, fname)
                 print('False color heatmap (with colorbar) written to: {}'.format(fname))
 
@@ -160,6 +940,10 @@ if __name__ == '__main__':
     if (args.negpos):
         if not args.negpos.lower().endswith('.png'):
             raise ValueError('False color output file must be in PNG format.')
-        fc = falsecolor_np(ref, test, args.epsilon)
-        plt.imsave(args.negpos, fc)
+        if args.tile:
+            falsecolor_np_tiled(args.ref, args.test, args.negpos,
+                                args.epsilon, args.tile, np.dtype(args.dtype))
+        else:
+            fc = falsecolor_np(ref, test, args.epsilon)
+            save_png(args.negpos, fc)
         print('False N/P color heatmap written to: {}'.format(args.negpos))
@@ -7,11 +7,283 @@ A script to batch render and update interactive viewer.
 import os
 import sys
 import argparse
-import pyexr
+import itertools
+import threading
+import time
 import numpy as np
 import json
 import subprocess as sp
-from analyze import update_stats, compute_stats, write_data
+from concurrent.futures import ThreadPoolExecutor
+from analyze import test_stats, publish_stats, ImageWriter, load_img, image_cache
+from metric import make_sidecar, compute_metrics, profiler
+
+
+def mitsuba_command(mitsuba, job, frequency=None, threads=None):
+    """Create Mitsuba command of a render job, and the path of its output."""
+
+    fname = '{}.exr'.format(job['name'].replace(' ', '-'))
+    out_path = os.path.join(os.path.dirname(job['scene']), fname)
+    render = '{} {} -D integrator={}'.format(mitsuba, job['scene'], job['alg'])
+    if frequency:
+        render = '{} -r {}'.format(render, frequency)
+    if threads:
+        render = '{} -p {}'.format(render, threads)
+    if job.get('options'):
+        render = '{} {}'.format(render, job['options'])
+    render = '{} -o {}'.format(render, out_path)
+    return render.split(), out_path
+
+
+def run_render(cmd, timeout=None, cpus=None, stop=None):
+    """Run Mitsuba, terminating it after timeout seconds (if given) or once
+    the stop threading.Event is set. Returns True if it was terminated.
+    With cpus, the process is pinned to these CPU ids (Linux only).
+    """
+
+    # Pinned from here rather than in a preexec_fn, which is unsafe with
+    # threads running, before Mitsuba starts its own threads
+    proc = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.STDOUT)
+    if cpus:
+        try:
+            os.sched_setaffinity(proc.pid, cpus)
+        except ProcessLookupError:
+            pass  # Already exited, its status is checked below
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        # Wake up regularly to check the stop event
+        wait = 0.5 if stop is not None else None
+        if deadline is not None:
+            wait = max(0, deadline - time.time()) if wait is None \
+                else min(wait, max(0, deadline - time.time()))
+        try:
+            out, _ = proc.communicate(timeout=wait)
+            break
+        except sp.TimeoutExpired:
+            if (deadline is not None and time.time() >= deadline) or \
+                    (stop is not None and stop.is_set()):
+                proc.kill()
+                proc.communicate()
+                return True
+    if proc.returncode != 0:
+        raise sp.CalledProcessError(proc.returncode, cmd, out)
+    return False
+
+
+def plateau_slope(x, y):
+    """Slope of log error over log time (-0.5 for a converging MC estimator's
+    RMSE, close to 0 once it plateaus)."""
+
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    valid = (x > 0) & (y > 0)
+    if np.count_nonzero(valid) < 2:
+        return None
+    return np.polyfit(np.log(x[valid]), np.log(y[valid]), 1)[0]
+
+
+def watch_render(out_path, start, score, stop, interval=1.0, finished=None):
+    """Call score(out_path, elapsed) for every new version of the image written
+    by a running render, until stop (a threading.Event) is set. A version is
+    scored once it has not changed for one polling interval, or when stopping
+    if finished (a threading.Event) is set, i.e. the render exited normally.
+    """
+
+    seen, scored = None, None
+    while True:
+        done = stop.wait(interval)
+        try:
+            st = os.stat(out_path)
+            stamp = (st.st_mtime, st.st_size)
+        except OSError:
+            stamp = None
+        # The last image is only complete if the render exited normally:
+        # a terminated one may have been killed while writing it
+        stable = stamp == seen or (done and finished is not None and finished.is_set())
+        if stamp is not None and stable and stamp != scored and stamp[0] >= start:
+            try:
+                score(out_path, stamp[0] - start)
+                scored = stamp
+            except Exception as e:
+                print('Warning: could not score {}: {}'.format(out_path, e))
+        seen = stamp
+        if done:
+            return
+
+
+def keep_image(last):
+    """Return a scoring function (see watch_render) only keeping the last
+    complete intermediate image of a render in last['image']."""
+
+    def score(fname, elapsed):
+        last['image'] = load_img(fname)
+
+    return score
+
+
+def live_tracker(job, args, stop=None, record=None, last=None):
+    """Return a scoring function appending (time, error) points of intermediate
+    images of a render to its convergence tracks, published after each point.
+    Once args.target (metric, error) is reached, or the error of the first
+    metric plateaus over the last args.plateau points, the stop event is set
+    and the reason is saved in record. The last scored image is kept in
+    last['image'], if given.
+    """
+
+    ref = image_cache.get(job['ref'], np.float32, 1.0)
+    tracks = dict((metric.upper(), {'x': [], 'y': []}) for metric in args.metrics)
+
+    def score(fname, elapsed):
+        with profiler.stage('live', image=job['name'], scene=job['dir']):
+            img = load_img(fname)
+            errors = compute_metrics(ref, img, args.metrics, args.epsilon, full=False)
+        if last is not None:
+            last['image'] = img
+        for metric in args.metrics:
+            track = tracks[metric.upper()]
+            track['x'].append(int(round(elapsed)))
+            track['y'].append(float('{:.6f}'.format(errors[metric][1])))
+        result = {'name': job['name'], 'metrics': dict(
+            (label, {'track': track}) for label, track in tracks.items())}
+
+        if stop is not None and not stop.is_set():
+            if args.target and errors[args.target[0]][1] <= args.target[1]:
+                label = '{} <= {:g}'.format(args.target[0].upper(), args.target[1])
+                result['targets'] = {label: '{:.1f}'.format(elapsed)}
+                record.update(stopped='target', time_to_target=elapsed)
+                stop.set()
+            elif args.plateau:
+                track = tracks[(args.target[0] if args.target else args.metrics[0]).upper()]
+                if len(track['x']) >= args.plateau:
+                    slope = plateau_slope(track['x'][-args.plateau:], track['y'][-args.plateau:])
+                    if slope is not None and abs(slope) < args.plateau_slope:
+                        record.update(stopped='plateau')
+                        stop.set()
+        publish_stats(job['dir'], [result])
+
+    return score
+
+
+def analyze_render(job, out_path, args, image=None):
+    """Compute metrics of a finished render and merge them into its scene.
+    If given, image is used instead of reading out_path (e.g. the last complete
+    intermediate image of a terminated render).
+    """
+
+    with profiler.stage('analysis', image=job['name'], scene=job['dir']):
+        ref = image_cache.get(job['ref'], np.float32, 1.0)
+        test = {'name': job['name'], 'data': load_img(out_path) if image is None else image}
+        with ImageWriter(pyramid=args.pyramid, hdr=args.hdrtiles, assets=args.assets) as writer:
+            result = test_stats(job['dir'], ref, test, args.metrics,
+                                args.clip, args.epsilon, writer)
+        publish_stats(job['dir'], [result])
+
+
+def read_matrix(fname, options=None):
+    """Expand a JSON render matrix into jobs (every algorithm on every scene).
+    Scenes have 'scene', 'ref', 'dir' and algorithms 'name', 'alg'; both can
+    have Mitsuba 'options', and algorithms a 'timeout' overriding --timeout.
+    """
+
+    with open(fname, 'r') as fp:
+        matrix = json.load(fp)
+
+    jobs = []
+    for scene, alg in itertools.product(matrix['scenes'], matrix['algorithms']):
+        job = dict(scene)
+        job.update(alg)
+        job['options'] = ' '.join(filter(None, [options, scene.get('options'),
+                                                alg.get('options')]))
+        jobs.append(job)
+    return jobs
+
+
+def schedule(jobs, args):
+    """Render jobs with at most args.concurrent Mitsuba processes at once.
+    Each render is analyzed on a separate thread as soon as it finishes, while
+    the next renders run. Returns the timing record of every job (seconds).
+    """
+
+    slots = list(range(args.concurrent))
+    # CPUs this process may run on (e.g. restricted by taskset or a container)
+    allowed = sorted(os.sched_getaffinity(0)) if args.pin else None
+    slots_lock = threading.Lock()
+    analysis = ThreadPoolExecutor(1, thread_name_prefix='analysis')
+    records = [{'scene': job['scene'], 'dir': job['dir'], 'name': job['name']} for job in jobs]
+    t0 = time.time()
+
+    def analyze(job, out_path, record, image):
+        start = time.time()
+        record['analysis_queue'] = start - record['end']
+        analyze_render(job, out_path, args, image)
+        record['analysis'] = time.time() - start
+
+    def render(job, record):
+        # Each concurrent render gets its own slot of CPUs
+        with slots_lock:
+            slot = slots.pop()
+        try:
+            cpus = None
+            if args.pin:
+                cpus = set(allowed[slot * args.threads:(slot + 1) * args.threads])
+            cmd, out_path = mitsuba_command(args.mitsuba, job, args.frequency, args.threads)
+            record['start'] = time.time()
+            record['queue'] = record['start'] - t0
+            timeout = job.get('timeout', args.timeout)
+
+            # A terminated render can leave a partially written output behind,
+            # so the last complete intermediate image is kept when it may be
+            early, watcher, last = None, None, {}
+            stop, finished = threading.Event(), threading.Event()
+            if args.live or (timeout and args.frequency):
+                if args.live:
+                    early = threading.Event()
+                    score = live_tracker(job, args, early, record, last)
+                else:
+                    score = keep_image(last)
+                watcher = threading.Thread(name='live-{}'.format(job['name']),
+                                           target=watch_render, args=(
+                    out_path, record['start'], score, stop, min(1.0, args.frequency / 4.0),
+                    finished))
+                watcher.start()
+            try:
+                with profiler.stage('render', image=job['name'], scene=job['dir']):
+                    terminated = run_render(cmd, timeout, cpus, early)
+                if terminated:
+                    record.setdefault('stopped', 'timeout')
+                else:
+                    finished.set()
+            finally:
+                if watcher is not None:
+                    stop.set()
+                    watcher.join()
+            record['end'] = time.time()
+            record['wall'] = record['end'] - record['start']
+        finally:
+            with slots_lock:
+                slots.append(slot)
+        print('Rendered {} on {} ({:.1f}s)'.format(job['name'], job['scene'], record['wall']))
+
+        image = None
+        if terminated:
+            if 'image' not in last:
+                raise Exception('Render was terminated before writing a complete image '
+                                '(intermediate images need --frequency)')
+            image = last['image']
+        return analysis.submit(analyze, job, out_path, record, image)
+
+    with ThreadPoolExecutor(args.concurrent, thread_name_prefix='render') as pool:
+        renders = [pool.submit(render, job, record) for job, record in zip(jobs, records)]
+        for future, record in zip(renders, records):
+            try:
+                future.result().result()
+            except Exception as e:
+                print('Error: {} on {} failed: {}'.format(record['name'], record['scene'], e))
+                record['error'] = str(e)
+    analysis.shutdown()
+
+    for record in records:
+        for key in ['start', 'end']:
+            record.pop(key, None)
+    return records
 
 
 if __name__ == '__main__':
@@ -21,17 +293,17 @@ if __name__ == '__main__':
     parser.add_argument('-mts', '--mitsuba',
                         help='mitsuba executable', type=str, default='./mitsuba')
     parser.add_argument('-r',   '--ref',
-                        help='reference image', type=str, required=True)
+                        help='reference image', type=str)
     parser.add_argument('-s',   '--scene',
-                        help='scene xml file', type=str, required=True)
+                        help='scene xml file', type=str)
     parser.add_argument('-o',   '--options',
                         help='mitsuba options', type=str)
     parser.add_argument('-d',   '--dir',
-                        help='corresponding viewer scene directory', type=str, required=True)
+                        help='corresponding viewer scene directory', type=str)
     parser.add_argument('-n',   '--name',
-                        help='algorithm name', type=str, required=True)
+                        help='algorithm name', type=str)
     parser.add_argument('-a',   '--alg',
-                        help='mitsuba algorithm keyword', type=str, required=True)
+                        help='mitsuba algorithm keyword', type=str)
     parser.add_argument('-t',   '--timeout',
                         help='render time (s)', type=int)
     parser.add_argument('-f',   '--frequency',
@@ -42,46 +314,87 @@ if __name__ == '__main__':
                         help='epsilon value', type=float, default=1e-2)
     parser.add_argument('-c',   '--clip',
                         help='clipping values for min/max', nargs=2, type=float, default=[0, 1])
+    parser.add_argument('-sc',  '--sidecar',
+                        help='convert reference to a memory-mapped .npy sidecar', action='store_true')
+    parser.add_argument('-pt',  '--pyramid',
+                        help='also write viewer images as a mip pyramid of N px tiles', type=int)
+    parser.add_argument('-ht',  '--hdrtiles',
+                        help='add half float tiles of HDR images to the pyramid', action='store_true')
+    parser.add_argument('-as',  '--assets',
+                        help='directory where viewer images are stored under their content hash', type=str)
+    parser.add_argument('-M',   '--matrix',
+                        help='JSON file of scenes and algorithms to render', type=str)
+    parser.add_argument('-j',   '--concurrent',
+                        help='number of concurrent renders', type=int, default=1)
+    parser.add_argument('-p',   '--threads',
+                        help='mitsuba threads per render', type=int)
+    parser.add_argument('-pin', '--pin',
+                        help='pin each concurrent render to its own THREADS cpus', action='store_true')
+    parser.add_argument('-lv',  '--live',
+                        help='track convergence of intermediate images during the render', action='store_true')
+    parser.add_argument('-te',  '--target-error',
+                        help='stop renders once METRIC=VALUE is reached (implies --live)', type=str)
+    parser.add_argument('-pl',  '--plateau',
+                        help='stop renders once the error plateaus over the last K samples (implies --live)', type=int)
+    parser.add_argument('-ps',  '--plateau-slope',
+                        help='log-log error slope under which the error has plateaued', type=float, default=0.05)
+    parser.add_argument('-l',   '--log',
+                        help='JSON file to write render timings to', type=str)
+    parser.add_argument('-pf',  '--profile',
+                        help='print time spent per stage; with FILE, also write a JSON report and FILE.trace.json',
+                        nargs='?', const='', type=str)
     args = parser.parse_args()
+    if args.profile is not None:
+        profiler.enable()
 
-    # Create Mistuba command
-    fname = '{}.exr'.format(args.name.replace(' ', '-'))
-    out_path = os.path.join(os.path.dirname(args.scene), fname)
-    render = '{} {} -D integrator={}'.format(
-        args.mitsuba, args.scene, args.alg)
-    if args.frequency:
-        render = '{} -r {}'.format(render, args.frequency)
-    if args.options:
-        render = '{} {}'.format(render, args.options)
-    render = '{} -o {}'.format(render, out_path)
-    cmd = render.split()
+    args.target = None
+    if args.target_error:
+        metric, value = args.target_error.split('=')
+        if metric.lower() not in (args.metrics or []):
+            raise Exception('Target metric {} is not computed (--metrics)'.format(metric))
+        args.target = (metric.lower(), float(value))
+    args.live = args.live or args.target is not None or args.plateau is not None
+    if args.live and not args.frequency:
+        raise Exception('Live tracking (--live) requires intermediate images (--frequency)')
+    if args.pin and not args.threads:
+        raise Exception('Pinning (--pin) requires a thread budget (--threads)')
+    if args.pin and args.concurrent * args.threads > len(os.sched_getaffinity(0)):
+        raise Exception('Pinning (--pin) needs {} x {} CPUs, only {} are available'.format(
+            args.concurrent, args.threads, len(os.sched_getaffinity(0))))
+    if args.matrix:
+        jobs = read_matrix(args.matrix, args.options)
+    else:
+        for arg in ['ref', 'scene', 'dir', 'name', 'alg']:
+            if getattr(args, arg) is None:
+                raise Exception('--{} is required without a render matrix (--matrix)'.format(arg))
+        jobs = [{'scene': args.scene, 'ref': args.ref, 'dir': args.dir,
+                 'name': args.name, 'alg': args.alg, 'options': args.options}]
 
-    # Run and time out after fixed amount of time
-    sys.stdout.write('Rendering... ')
-    sys.stdout.flush()
-    try:
-        out = sp.check_output(cmd, shell=False, timeout=args.timeout)
-    except sp.TimeoutExpired as e:
-        print('done.')
+    if args.sidecar:
+        for ref in sorted(set(job['ref'] for job in jobs)):
+            make_sidecar(ref)
 
-    # Update interactive viewer
-    sys.stdout.write('Recomputing metrics... ')
+    # Render and update interactive viewer
+    sys.stdout.write('Rendering {} job(s)...\n'.format(len(jobs)))
     sys.stdout.flush()
-    ref_fp = pyexr.open(args.ref)
-    ref = np.array(ref_fp.get())
-    img_fp = pyexr.open(out_path)
-    img = np.array(img_fp.get())
-    test = [{'name': args.name, 'data': img}]
-
-    with open(os.path.join(args.dir, 'data.json'), 'r') as fp:
-        data = json.load(fp)
-    with open(os.path.join(args.dir, 'stats.json'), 'r') as fp:
-        stats = json.load(fp)
-
-    data = update_stats(args.dir, data, ref, test,
-                        args.metrics, args.clip, args.epsilon)
-    write_data(args.dir, data)
+    records = schedule(jobs, args)
     print('done.')
 
-    web_url = os.path.abspath(os.path.join(args.dir, 'index.html'))
-    print('Interactive viewer updated: {}'.format(web_url))
+    print('{:<24} {:<32} {:>8} {:>8} {:>8} {:>8}'.format(
+        'Algorithm', 'Scene', 'Queue', 'Render', 'Metrics', 'Stopped'))
+    for r in records:
+        print('{:<24} {:<32} {:>8.1f} {:>8.1f} {:>8.1f} {:>8}'.format(
+            r['name'], os.path.basename(os.path.normpath(r['dir'])), r.get('queue', 0),
+            r.get('wall', 0), r.get('analysis', 0), r.get('stopped', '-')))
+    if args.log:
+        with open(args.log, 'w') as fp:
+            json.dump(records, fp, indent=4)
+    if args.profile is not None:
+        profiler.print_summary()
+        if args.profile:
+            trace = profiler.save(args.profile)
+            print('Profile written to: {} ({})'.format(args.profile, trace))
+
+    for d in sorted(set(job['dir'] for job in jobs)):
+        web_url = os.path.abspath(os.path.join(d, 'index.html'))
+        print('Interactive viewer updated: {}'.format(web_url))
@@ -8,97 +8,298 @@ with Jeri in-browser visualization tool.
 
 import re
 import os
+import html
+import sys
+import glob
+import json
+import shlex
 import shutil
+import hashlib
 import argparse
 import pathlib
-from bs4 import BeautifulSoup as Soup
+import threading
+import time
+import subprocess as sp
+from concurrent.futures import ThreadPoolExecutor
+from metric import atomic_write
 
 
-def add_to_index(root_dir, scene_name):
-    """Add new scene to index."""
+def scene_slug(scene_name):
+    """Directory name of a scene."""
 
+    return scene_name.lower().replace(' ', '-')
+
+
+def load_registry(root_dir):
+    """Load the list of scenes ({'name', 'slug'}) from scenes.json.
+    Roots created before the registry are migrated from their index.html.
+    """
+
+    registry = os.path.join(root_dir, 'scenes.json')
+    if os.path.exists(registry):
+        with open(registry, 'r') as fp:
+            return json.load(fp)['scenes']
+
+    scenes = []
     index = os.path.join(root_dir, 'index.html')
-    soup = Soup(open(index).read(), 'html.parser')
-    scenes = soup.findAll('div', {"class": 'element-container'})[0]
-    new_scene = soup.new_tag('div', **{'class': 'report-preview'})
-    path_dir = os.path.join('scenes', scene_name.lower().replace(' ', '-'))
-    scene_link = soup.new_tag('a', href=os.path.join(path_dir, 'index.html'))
-    thumb = soup.new_tag('img', src=os.path.join(path_dir, 'thumb.png'), **{'class': 'report-thumb'})
+    if os.path.exists(index):
+        # Only needed once, to migrate roots created before the registry
+        from bs4 import BeautifulSoup as Soup
+        soup = Soup(open(index).read(), 'html.parser')
+        for s in soup.find_all('div', **{'class': 'report-preview'}):
+            slug = s.find('a').attrs['href'].split('/')[1]
+            scenes.append({'name': s.get_text().strip(), 'slug': slug})
+    return scenes
+
+
+def save_registry(root_dir, scenes):
+    """Write scenes.json and regenerate index.html from it."""
+
+    atomic_write(os.path.join(root_dir, 'scenes.json'),
+                 json.dumps({'scenes': scenes}, indent=4))
+    write_index(root_dir, scenes)
 
-    scene_link.append(thumb)
-    new_scene.append(scene_link)
-    new_scene.append(soup.new_tag('br'))
-    new_scene.append(scene_name)
-    scenes.append(new_scene)
 
-    with open(index, 'w') as fp:
-        fp.write(str(soup.prettify(indent_width=4)))
+def container_span(page):
+    """Return the (start, end) offsets of the content of the scene container
+    (div of class element-container) of an index page.
+    """
+
+    start = re.search(r'<div[^>]*class="element-container"[^>]*>', page)
+    if start is None:
+        raise Exception('Could not find the scene container in index')
+    depth = 1
+    for tag in re.finditer(r'<(/?)div\b[^>]*>', page[start.end():]):
+        depth += -1 if tag.group(1) else 1
+        if depth == 0:
+            return start.end(), start.end() + tag.start()
+    raise Exception('Unclosed scene container in index')
+
+
+def write_index(root_dir, scenes):
+    """Replace the scene previews of index.html with those of scenes,
+    keeping the rest of the page as is."""
+
+    index = os.path.join(root_dir, 'index.html')
+    with open(index, 'r') as fp:
+        page = fp.read()
+    start, end = container_span(page)
+
+    indent = ' ' * 16
+    previews = []
+    for scene in scenes:
+        path_dir = 'scenes/{}'.format(html.escape(scene['slug']))
+        previews.append('\n'.join([
+            '<div class="report-preview">',
+            '    <a href="{}/index.html">'.format(path_dir),
+            '        <img class="report-thumb" src="{}/thumb.png"/>'.format(path_dir),
+            '    </a>',
+            '    <br/>',
+            '    {}'.format(html.escape(scene['name'], quote=False)),
+            '</div>']))
+    content = ''.join('\n' + indent + p.replace('\n', '\n' + indent) for p in previews)
+    atomic_write(index, page[:start] + content + '\n' + ' ' * 12 + page[end:])
+
+
+def add_to_index(root_dir, scene_names):
+    """Add new scenes to index. Returns the names of the added scenes."""
+
+    scenes = load_registry(root_dir)
+    slugs = set(s['slug'] for s in scenes)
+    added = []
+    for name in scene_names:
+        if scene_slug(name) in slugs:
+            print('Scene {} is already in index'.format(name))
+            continue
+        scenes.append({'name': name, 'slug': scene_slug(name)})
+        slugs.add(scene_slug(name))
+        added.append(name)
+    save_registry(root_dir, scenes)
+    return added
 
 
 def list_index(root_dir):
     """List all the scenes in index."""
 
-    index = os.path.join(root_dir, 'index.html')
-    soup = Soup(open(index).read(), 'html.parser')
     print('All scenes: ')
-    for s in soup.find_all('div', **{'class': 'report-preview'}):
-        name = s.find('a').attrs['href'].split(os.path.sep)[1]
-        print(' * {}'.format(name))
+    for s in load_registry(root_dir):
+        print(' * {}'.format(s['slug']))
 
 
-def remove_from_index(root_dir, scene_name):
-    """Return true if targeted scene was deleted from index."""
+def remove_from_index(root_dir, scene_names):
+    """Remove scenes from index. Returns the names of the removed scenes."""
 
-    index = os.path.join(root_dir, 'index.html')
-    soup = Soup(open(index).read(), 'html.parser')
-    scenes = soup.findAll('div', {'class': 'element-container'})[0]
-    
-    # Find the html node
-    scene_node = None
-    for s in soup.find_all('div', **{'class': 'report-preview'}):
-        name = s.find('a').attrs['href'].split(os.path.sep)[1]
-        if name == scene_name.lower().replace(' ', '-'):
-            scene_node = s
-
-    if scene_node == None:
-        print('Unable to find scene {} in index'.format(scene_name))
-        return False
-    else:
-        scenes.contents.remove(scene_node)
-        index = os.path.join(root_dir, 'index.html')
-        with open(index, 'w') as fp:
-            fp.write(str(soup.prettify(indent_width=4)))
-        return True
+    scenes = load_registry(root_dir)
+    removed = []
+    for name in scene_names:
+        found = [s for s in scenes if s['slug'] == scene_slug(name)]
+        if not found:
+            print('Unable to find scene {} in index'.format(name))
+            continue
+        scenes.remove(found[0])
+        removed.append(name)
+    if removed:
+        save_registry(root_dir, scenes)
+    return removed
 
 
-def create_dummy(interactive_dir, root_dir, scene_name):
-    """Create dummy index file for scene."""
+def create_dummy(interactive_dir, root_dir, scene_names):
+    """Create dummy index files for scenes."""
 
-    scene_dir = os.path.join(root_dir, 'scenes', scene_name.lower().replace(' ', '-'))
-    if not os.path.exists(scene_dir):
-        os.makedirs(scene_dir)
+    from bs4 import BeautifulSoup as Soup
 
     example_index = os.path.join(interactive_dir, 'tools', 'example.html')
     soup = Soup(open(example_index).read(), 'html.parser')
-
-    soup.title.string = scene_name
     title = soup.find('h1', **{'class': 'title'})
-    title.string = scene_name
 
-    with open(os.path.join(scene_dir, 'index.html'), 'w') as fp:
-        fp.write(str(soup))
+    for scene_name in scene_names:
+        scene_dir = os.path.join(root_dir, 'scenes', scene_slug(scene_name))
+        if not os.path.exists(scene_dir):
+            os.makedirs(scene_dir)
+
+        soup.title.string = scene_name
+        title.string = scene_name
+
+        with open(os.path.join(scene_dir, 'index.html'), 'w') as fp:
+            fp.write(str(soup))
 
 
 def remove_dummy(root_dir, scene_name):
     """Remove dummy scene from index."""
 
-    scene_dir = os.path.join(root_dir, 'scenes', scene_name.lower().replace(' ', '-'))
+    scene_dir = os.path.join(root_dir, 'scenes', scene_slug(scene_name))
     if not os.path.exists(scene_dir):
         print('Warning: scene directory {} does not exist'.format(scene_dir))
     else:
         shutil.rmtree(scene_dir)
 
 
+def find_scenes(root_dir, names=None):
+    """Return the directories of scenes with a reference render (Reference.exr),
+    optionally only those of the given scene names.
+    """
+
+    scenes_dir = os.path.join(root_dir, 'scenes')
+    if names:
+        dirs = [os.path.join(scenes_dir, scene_slug(n)) for n in names]
+    else:
+        dirs = sorted(glob.glob(os.path.join(scenes_dir, '*', '')))
+    scene_dirs = []
+    for d in dirs:
+        d = os.path.normpath(d)
+        if os.path.exists(os.path.join(d, 'Reference.exr')):
+            scene_dirs.append(d)
+        else:
+            print('Warning: no Reference.exr in {}, skipped'.format(d))
+    return scene_dirs
+
+
+def input_files(scene_dir):
+    """Files read by analyze.py in automatic mode: reference and partial renders."""
+
+    files = [os.path.join(scene_dir, 'Reference.exr')]
+    files += sorted(glob.glob(os.path.join(scene_dir, '*_partial', '*')))
+    return files
+
+
+def inputs_hash(scene_dir, args):
+    """Hash of the analysis arguments and of the stamps (path, mtime, size)
+    of all input files of a scene."""
+
+    h = hashlib.sha1(json.dumps(args).encode('utf8'))
+    for f in input_files(scene_dir):
+        st = os.stat(f)
+        h.update('{}:{}:{}\n'.format(os.path.relpath(f, scene_dir), st.st_mtime,
+                                      st.st_size).encode('utf8'))
+    return h.hexdigest()
+
+
+def estimate_memory(scene_dir, metrics):
+    """Rough peak memory of analyze.py on a scene (MB): float32 reference and
+    representative images, shared difference buffers and error images."""
+
+    import OpenEXR
+
+    header = OpenEXR.InputFile(os.path.join(scene_dir, 'Reference.exr')).header()
+    dw = header['dataWindow']
+    pixels = (dw.max.x - dw.min.x + 1) * (dw.max.y - dw.min.y + 1)
+    algorithms = len(glob.glob(os.path.join(scene_dir, '*_partial')))
+    images = 1 + algorithms + 2 + len(metrics)
+    return images * pixels * 3 * 4 / float(1 << 20) + 150
+
+
+def analyze_scenes(scene_dirs, metrics, options=None, jobs=1, budget=8192, force=False):
+    """Run analyze.py in automatic mode on every scene, with at most jobs
+    processes at once whose estimated memory fits in budget (MB); a scene
+    larger than the budget runs alone. Scenes whose inputs and arguments are
+    unchanged since their last data.json are skipped, unless forced.
+    Returns the record of every scene (status, seconds and peak memory).
+    """
+
+    analyze = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'analyze.py')
+    extra = shlex.split(options or '')
+    state = {'reserved': 0, 'running': 0}
+    cond = threading.Condition()
+
+    def run(scene_dir, record):
+        batch_path = os.path.join(scene_dir, 'batch.json')
+        inputs = inputs_hash(scene_dir, [metrics, extra])
+        if not force and os.path.exists(os.path.join(scene_dir, 'data.json')) \
+                and os.path.exists(batch_path):
+            with open(batch_path, 'r') as fp:
+                if json.load(fp).get('inputs') == inputs:
+                    record['status'] = 'unchanged'
+                    print('Skipped {} (unchanged)'.format(record['scene']))
+                    return
+
+        # Wait until the scene fits in the memory budget
+        memory = record['estimate'] = estimate_memory(scene_dir, metrics)
+        with cond:
+            cond.wait_for(lambda: state['running'] == 0 or
+                          state['reserved'] + memory <= budget)
+            state['reserved'] += memory
+            state['running'] += 1
+        try:
+            cmd = [sys.executable, analyze, '-A', scene_dir, '-d', scene_dir,
+                   '-m'] + metrics + extra
+            start = time.time()
+            with open(os.path.join(scene_dir, 'analyze.log'), 'w') as log:
+                proc = sp.Popen(cmd, stdout=log, stderr=sp.STDOUT)
+                _, status, rusage = os.wait4(proc.pid, 0)
+                # Same convention as subprocess: -N if killed by signal N
+                proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) \
+                    else -os.WTERMSIG(status)
+            record['wall'] = time.time() - start
+            record['rss'] = rusage.ru_maxrss / 1024.0
+        finally:
+            with cond:
+                state['reserved'] -= memory
+                state['running'] -= 1
+                cond.notify_all()
+
+        if proc.returncode != 0:
+            record['status'] = 'failed'
+            print('Error: {} failed, see {}'.format(
+                record['scene'], os.path.join(scene_dir, 'analyze.log')))
+            return
+        with open(batch_path, 'w') as fp:
+            json.dump({'inputs': inputs, 'wall': record['wall']}, fp)
+        record['status'] = 'done'
+        print('Analyzed {} ({:.1f}s)'.format(record['scene'], record['wall']))
+
+    records = [{'scene': os.path.basename(d), 'dir': d} for d in scene_dirs]
+    with ThreadPoolExecutor(max(jobs, 1)) as pool:
+        futures = [pool.submit(run, d, r) for d, r in zip(scene_dirs, records)]
+        for future, record in zip(futures, records):
+            try:
+                future.result()
+            except Exception as e:
+                print('Error: {} failed: {}'.format(record['scene'], e))
+                record['status'] = 'failed'
+                record['error'] = str(e)
+    return records
+
+
 if __name__ == '__main__':
     # Parse arguments
     parser = argparse.ArgumentParser(description='HTML Scene Manager')
@@ -106,23 +307,25 @@ if __name__ == '__main__':
     subparsers = parser.add_subparsers(dest='action')
     # Create new scene
     parser_add = subparsers.add_parser('add')
-    parser_add.add_argument('-n', '--name', help='scene name', type=str)
+    parser_add.add_argument('-n', '--name', help='scene name(s)', nargs='+', type=str)
     # List scenes
     parser_list = subparsers.add_parser('list')
     # Remove scene
     parser_remove = subparsers.add_parser('remove')
-    parser_remove.add_argument('-n', '--name', help='scene name', type=str)
+    parser_remove.add_argument('-n', '--name', help='scene name(s)', nargs='+', type=str)
+    # Analyze all (or some) scenes
+    parser_analyze = subparsers.add_parser('analyze')
+    parser_analyze.add_argument('-n', '--names', help='scene names (default: all scenes)', nargs='+', type=str)
+    parser_analyze.add_argument('-m', '--metrics', help='difference metrics', nargs='+',
+                                choices=['l1', 'l2', 'mrse', 'mape', 'smape', 'dssim'], type=str, required=True)
+    parser_analyze.add_argument('-o', '--options', help='extra analyze.py arguments', type=str)
+    parser_analyze.add_argument('-j', '--jobs', help='scenes analyzed at once', type=int, default=os.cpu_count())
+    parser_analyze.add_argument('-mem', '--memory', help='memory budget of all running analyses (MB)', type=int, default=8192)
+    parser_analyze.add_argument('-f', '--force', help='also analyze unchanged scenes', action='store_true')
+    parser_analyze.add_argument('-l', '--log', help='JSON file to write per-scene timings to', type=str)
 
     args = parser.parse_args()
 
-    # Soup prettify override
-    orig_prettify = Soup.prettify
-    r = re.compile(r'^(\s*)', re.MULTILINE)
-
-    def prettify(self, encoding=None, formatter='minimal', indent_width=4):
-        return r.sub(r'\1' * indent_width, orig_prettify(self, encoding, formatter))
-    Soup.prettify = prettify
-
     if not os.path.exists(args.root):
         os.makedirs(args.root)
 
@@ -147,13 +350,29 @@ if __name__ == '__main__':
 
     # Update directory index and create dummy file for new scene
     if args.action == 'add':
-        add_to_index(args.root, args.name)
-        create_dummy(interactive_dir, args.root, args.name)
+        create_dummy(interactive_dir, args.root, add_to_index(args.root, args.name))
     # Update HTML index and remove dummy file
     elif args.action == 'remove':
-        found = remove_from_index(args.root, args.name)
-        if found: remove_dummy(args.root, args.name)
+        for name in remove_from_index(args.root, args.name):
+            remove_dummy(args.root, name)
     elif args.action == 'list':
         list_index(args.root)
+    elif args.action == 'analyze':
+        scene_dirs = find_scenes(args.root, args.names)
+        print('Analyzing {} scene(s)...'.format(len(scene_dirs)))
+        start = time.time()
+        records = analyze_scenes(scene_dirs, args.metrics, args.options,
+                                 args.jobs, args.memory, args.force)
+        print('done ({:.1f}s).'.format(time.time() - start))
+
+        print('{:<32} {:>10} {:>8} {:>10} {:>10}'.format(
+            'Scene', 'Status', 'Time', 'Est. MB', 'Peak MB'))
+        for r in records:
+            print('{:<32} {:>10} {:>8.1f} {:>10.0f} {:>10.0f}'.format(
+                r['scene'], r.get('status', '-'), r.get('wall', 0),
+                r.get('estimate', 0), r.get('rss', 0)))
+        if args.log:
+            with open(args.log, 'w') as fp:
+                json.dump(records, fp, indent=4)
     else:
         raise Exception('Unknown action: {}'.format(args.action))
\ No newline at end of file
@@ -0,0 +1,61 @@
+/*!
+    DataChunks.js
+    Released under the MIT license
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy of this
+    software and associated documentation files (the "Software"), to deal in the Software
+    without restriction, including without limitation the rights to use, copy, modify,
+    merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+    permit persons to whom the Software is furnished to do so, subject to the following
+    conditions:
+
+    The above copyright notice and this permission notice shall be included in all copies
+    or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+    INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+    PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+    HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+    OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+    SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+*/
+
+// Chunks of data.js written by analyze.py --chunks are plain scripts (so that
+// they also load from file:// pages) calling dataChunk() with their path and content.
+var dataChunkCallbacks = {};
+
+function dataChunk(path, value) {
+    var callbacks = dataChunkCallbacks[path] || [];
+    delete dataChunkCallbacks[path];
+    for (var i = 0; i < callbacks.length; ++i) {
+        callbacks[i](value);
+    }
+}
+
+function loadDataChunk(path, callback) {
+    if (dataChunkCallbacks[path]) {
+        dataChunkCallbacks[path].push(callback);
+        return;
+    }
+    dataChunkCallbacks[path] = [callback];
+
+    var script = document.createElement('script');
+    script.src = path;
+    document.head.appendChild(script);
+}
+
+// Convergence tracks stored as base64 float32 arrays (--chunks float32)
+function decodeTrack(track) {
+    if (track['dtype'] !== 'float32') {
+        return track;
+    }
+    function unpack(b64) {
+        var bytes = atob(b64);
+        var buffer = new Uint8Array(bytes.length);
+        for (var i = 0; i < bytes.length; ++i) {
+            buffer[i] = bytes.charCodeAt(i);
+        }
+        return Array.from(new Float32Array(buffer.buffer));
+    }
+    return { x: track['x'].map(unpack), y: track['y'].map(unpack) };
+}
@@ -28,9 +28,158 @@
 var imageBoxSettings = {
     zoom: 0.1,
     width: 1152,
-    height: 720
+    height: 720,
+    exposure: 0,
+    maxHdrTiles: 256
 };
 
+// Tonemapped half float tiles, as object URLs keyed by tile and exposure
+// (Map iteration order is used to evict the least recently used ones)
+var hdrTileCache = new Map();
+var hdrTileLoading = {};
+var halfToFloat = null;
+
+function decodeHalf(buffer) {
+    if (!halfToFloat) {
+        halfToFloat = new Float32Array(65536);
+        for (var h = 0; h < 65536; ++h) {
+            var e = (h >> 10) & 0x1f;
+            var f = h & 0x3ff;
+            var v;
+            if (e === 0) {
+                v = f * Math.pow(2, -24);
+            } else if (e === 31) {
+                v = f ? NaN : Infinity;
+            } else {
+                v = (1 + f / 1024) * Math.pow(2, e - 15);
+            }
+            halfToFloat[h] = (h & 0x8000) ? -v : v;
+        }
+    }
+    var bits = new Uint16Array(buffer);
+    var pixels = new Float32Array(bits.length);
+    for (var i = 0; i < bits.length; ++i) {
+        pixels[i] = halfToFloat[bits[i]];
+    }
+    return pixels;
+}
+
+// Return the object URL of a half float tile tonemapped at the current exposure,
+// or null if it is still loading (img is then updated once it is ready).
+// Tiles that cannot be fetched (e.g. viewer opened from file://) return undefined.
+function hdrTile(img, url, width, height, channels) {
+    var exposure = imageBoxSettings.exposure;
+    var key = url + '@' + exposure;
+    if (hdrTileCache.has(key)) {
+        var objectUrl = hdrTileCache.get(key);
+        hdrTileCache.delete(key);
+        hdrTileCache.set(key, objectUrl);
+        return objectUrl;
+    }
+    if (hdrTileLoading[url] === false) {
+        return undefined;
+    }
+    if (hdrTileLoading[key]) {
+        return null;
+    }
+    hdrTileLoading[key] = true;
+
+    fetch(url).then(function(response) {
+        if (!response.ok) {
+            throw new Error(response.statusText);
+        }
+        return response.arrayBuffer();
+    }).then(function(buffer) {
+        // Same tonemapping as analyze.py, after scaling by 2^exposure
+        var pixels = decodeHalf(buffer);
+        var canvas = document.createElement('canvas');
+        canvas.width = width;
+        canvas.height = height;
+        var ctx = canvas.getContext('2d');
+        var ldr = ctx.createImageData(width, height);
+        var scale = Math.pow(2, exposure);
+        for (var i = 0; i < width * height; ++i) {
+            for (var c = 0; c < 3; ++c) {
+                var v = pixels[i * channels + Math.min(c, channels - 1)] * scale;
+                ldr.data[4 * i + c] = Math.floor(Math.min(Math.pow(Math.max(v, 0), 1 / 2.2), 1) * 255);
+            }
+            ldr.data[4 * i + 3] = 255;
+        }
+        ctx.putImageData(ldr, 0, 0);
+        canvas.toBlob(function(blob) {
+            hdrTileCache.set(key, URL.createObjectURL(blob));
+            delete hdrTileLoading[key];
+            while (hdrTileCache.size > imageBoxSettings.maxHdrTiles) {
+                var oldest = hdrTileCache.keys().next().value;
+                URL.revokeObjectURL(hdrTileCache.get(oldest));
+                hdrTileCache.delete(oldest);
+            }
+            updateTiles(img);
+        });
+    }).catch(function() {
+        hdrTileLoading[url] = false;
+        delete hdrTileLoading[key];
+        updateTiles(img);
+    });
+    return null;
+}
+
+// Show the pyramid tiles covering the visible part of a tiled image, drawn
+// over its coarsest level which stays visible while tiles are loading.
+// Away from the exposure baked into the PNG tiles, HDR images use their half float tiles.
+function updateTiles(img) {
+    var tiles = img.tiles;
+
+    // Coarsest level with at least one texel per screen pixel
+    var scale = img.bgWidth / img.imWidth * (window.devicePixelRatio || 1);
+    var level = Math.floor(Math.log2(1 / scale));
+    level = Math.min(Math.max(level, 0), tiles.levels - 1);
+    var w = tiles.width;
+    var h = tiles.height;
+    for (var l = 0; l < level; ++l) {
+        w = Math.ceil(w / 2);
+        h = Math.ceil(h / 2);
+    }
+
+    // Tiles overlapping the element (hidden elements have no size and load no tiles)
+    var x0 = img.bgOffsetX + img.bgPosX;
+    var y0 = img.bgOffsetY + img.bgPosY;
+    var tileW = tiles.size * img.bgWidth / w;
+    var tileH = tiles.size * img.bgHeight / h;
+    var c0 = Math.max(0, Math.floor(-x0 / tileW));
+    var r0 = Math.max(0, Math.floor(-y0 / tileH));
+    var c1 = Math.min(Math.ceil(w / tiles.size), Math.ceil((img.offsetWidth - x0) / tileW));
+    var r1 = Math.min(Math.ceil(h / tiles.size), Math.ceil((img.offsetHeight - y0) / tileH));
+
+    var images = [], sizes = [], positions = [];
+    for (var r = r0; r < r1; ++r) {
+        for (var c = c0; c < c1; ++c) {
+            var tw = Math.min(tiles.size, w - c * tiles.size);
+            var th = Math.min(tiles.size, h - r * tiles.size);
+            var url = tiles.path + '/' + level + '/' + r + '_' + c;
+            if (tiles.hdr && imageBoxSettings.exposure != 0) {
+                var hdrUrl = hdrTile(img, url + '.f16', tw, th, tiles.hdr);
+                if (hdrUrl === null) {
+                    continue;
+                }
+                url = hdrUrl || url + '.png';
+            } else {
+                url += '.png';
+            }
+            images.push('url("' + url + '")');
+            sizes.push((tw * tileW / tiles.size) + 'px ' + (th * tileH / tiles.size) + 'px');
+            positions.push((x0 + c * tileW) + 'px ' + (y0 + r * tileH) + 'px');
+        }
+    }
+    images.push('url("' + img.coarse + '")');
+    sizes.push(img.bgWidth + 'px ' + img.bgHeight + 'px');
+    positions.push(x0 + 'px ' + y0 + 'px');
+
+    img.style.backgroundImage = images.join(', ');
+    img.style.backgroundSize = sizes.join(', ');
+    img.style.backgroundPosition = positions.join(', ');
+}
+
 window.wheelzoom = (function(){
 
     var canvas = document.createElement('canvas');
@@ -44,12 +193,13 @@ window.wheelzoom = (function(){
         var cachedDataUrl;
 
         function setSrcToBackground(img) {
+            img.coarse = img.src;
             img.style.backgroundImage = 'url("'+img.src+'")';
             img.style.backgroundRepeat = 'no-repeat';
             canvas.width = settings.width;
             canvas.height = Math.min(720, canvas.width * (img.imHeight / img.imWidth));
-            img.bgOffsetX = (canvas.width - img.naturalWidth)/2;
-            img.bgOffsetY = (canvas.height - img.naturalHeight)/2;
+            img.bgOffsetX = (canvas.width - img.imWidth)/2;
+            img.bgOffsetY = (canvas.height - img.imHeight)/2;
             cachedDataUrl = canvas.toDataURL();
             img.src = cachedDataUrl;
 
@@ -76,6 +226,9 @@ window.wheelzoom = (function(){
 
             img.style.backgroundSize = img.bgWidth+'px '+img.bgHeight+'px';
             img.style.backgroundPosition = (img.bgOffsetX + img.bgPosX)+'px '+ (img.bgOffsetY + img.bgPosY)+'px';
+            if (img.tiles) {
+                updateTiles(img);
+            }
 
             // // Apply anti-aliasing when not zoomed in too much, and when not viewing at a power of 2.
             // var globalZoomFactor = img.bgWidth / img.imWidth;
@@ -166,8 +319,9 @@ window.wheelzoom = (function(){
         function load() {
             if (img.src === cachedDataUrl) return;
 
-            img.imWidth = img.naturalWidth;
-            img.imHeight = img.naturalHeight;
+            // Tiled images only load their coarsest level here
+            img.imWidth = img.tiles ? img.tiles.width : img.naturalWidth;
+            img.imHeight = img.tiles ? img.tiles.height : img.naturalHeight;
 
             img.bgWidth = img.imWidth;
             img.bgHeight = img.imHeight;
@@ -293,11 +447,22 @@ ImageBox.prototype.buildTreeNode = function(config, level, nodeList, parent) {
             content = document.createElement('div');
             this.buildTreeNode(config[i].elements, level+1, contentNode.children, content);
             selector.appendChild(document.createTextNode(config[i].title));
+        } else if (typeof(config[i].chunk) !== 'undefined') {
+            // Elements are in a data chunk, only loaded once shown
+            content = document.createElement('div');
+            contentNode.chunk = config[i].chunk;
+            selector.appendChild(document.createTextNode(config[i].title));
         } else {
             // Create image
             content = document.createElement('img');
             content.className = "image-display pixelated";
-            content.src = config[i].image;
+            if (typeof(config[i].tiles) !== 'undefined') {
+                var tiles = config[i].tiles;
+                content.tiles = tiles;
+                content.src = tiles.path + '/' + (tiles.levels - 1) + '/0_0.png';
+            } else {
+                content.src = config[i].image;
+            }
             wheelzoom(content, imageBoxSettings);
             var key = '';
             if (i < 9)
@@ -316,7 +481,12 @@ ImageBox.prototype.buildTreeNode = function(config, level, nodeList, parent) {
             // Create inset
             var inset = document.createElement('img');
             inset.className = "inset pixelated";
-            inset.style.backgroundImage = "url('" + config[i].image + "')";
+            // Full resolution image of tiled entries is only fetched once insets are used
+            if (typeof(config[i].tiles) !== 'undefined') {
+                inset.lazyImage = config[i].image;
+            } else {
+                inset.style.backgroundImage = "url('" + config[i].image + "')";
+            }
             inset.style.backgroundRepeat = "no-repeat";
             inset.style.border = "0px solid black";
             inset.style.width  = Math.min(256, imageBoxSettings.width / config.length-4) + "px";
@@ -368,28 +538,40 @@ ImageBox.prototype.buildTreeNode = function(config, level, nodeList, parent) {
     }
 }
 
+ImageBox.prototype.loadChunk = function(node, level) {
+    if (node.loading) {
+        return;
+    }
+    node.loading = true;
+    loadDataChunk(node.chunk, function(elements) {
+        this.buildTreeNode(elements, level+1, node.children, node.content);
+        for (var i = 0; i < this.selection.length; ++i) {
+            this.selection[i] = this.selection[i] || 0;
+        }
+        delete node.chunk;
+        this.showContent(level, this.selection[level]);
+    }.bind(this));
+}
+
 ImageBox.prototype.showContent = function(level, idx) {
-    // Hide
-    var bgWidth = 0;
-    var bgHeight = 0;
-    var bgPosX = 0;
-    var bgPosY = 0;
-    var bgOffsetX = 0;
-    var bgOffsetY = 0;
+    // Hide (keeping the view of the displayed image, if any, for the next one)
     var l = 0;
     var node = {};
     node.children = this.tree;
     while (node.children.length > 0 && node.children.length > this.selection[l]) {
         node = node.children[this.selection[l]];
         node.selector.className = 'selector selector-primary';
+        var shown = node.content.style.display != 'none';
         node.content.style.display = 'none';
-        if (l == this.selection.length-1) {
-            bgWidth =   node.content.bgWidth;
-            bgHeight =  node.content.bgHeight;
-            bgPosX =    node.content.bgPosX;
-            bgPosY =    node.content.bgPosY;
-            bgOffsetX =  node.content.bgOffsetX;
-            bgOffsetY =  node.content.bgOffsetY;
+        if (l == this.selection.length-1 && node.children.length == 0 && shown) {
+            this.view = {
+                bgWidth:    node.content.bgWidth,
+                bgHeight:   node.content.bgHeight,
+                bgPosX:     node.content.bgPosX,
+                bgPosY:     node.content.bgPosY,
+                bgOffsetX:  node.content.bgOffsetX,
+                bgOffsetY:  node.content.bgOffsetY
+            };
         }
         l += 1;
     }
@@ -406,22 +588,33 @@ ImageBox.prototype.showContent = function(level, idx) {
         node = node.children[this.selection[l]];
         node.selector.className = 'selector selector-primary active';
         node.content.style.display = 'block';
-        if (l == this.selection.length-1) {
-            node.content.bgWidth = bgWidth;
-            node.content.bgHeight = bgHeight;
-            node.content.bgPosX = bgPosX;
-            node.content.bgPosY = bgPosY;
-            node.content.bgOffsetX = bgOffsetX;
-            node.content.bgOffsetY = bgOffsetY;
-            node.content.style.backgroundSize = bgWidth+'px '+bgHeight+'px';
-            node.content.style.backgroundPosition = (bgOffsetX + bgPosX)+'px '+ (bgOffsetY + bgPosY)+'px';
+        if (node.chunk) {
+            this.loadChunk(node, l);
+        }
+        var view = this.view;
+        if (l == this.selection.length-1 && node.children.length == 0 && !node.chunk && view && view.bgWidth) {
+            node.content.bgWidth = view.bgWidth;
+            node.content.bgHeight = view.bgHeight;
+            node.content.bgPosX = view.bgPosX;
+            node.content.bgPosY = view.bgPosY;
+            node.content.bgOffsetX = view.bgOffsetX;
+            node.content.bgOffsetY = view.bgOffsetY;
+            node.content.style.backgroundSize = view.bgWidth+'px '+view.bgHeight+'px';
+            node.content.style.backgroundPosition = (view.bgOffsetX + view.bgPosX)+'px '+ (view.bgOffsetY + view.bgPosY)+'px';
+            if (node.content.tiles) {
+                updateTiles(node.content);
+            }
         }
         l += 1;
     }
 }
 
 ImageBox.prototype.keyPressHandler = function(event) {
-    if (parseInt(event.charCode) == "0".charCodeAt(0)) {
+    if (event.key == "+" || event.key == "-") {
+        // Change exposure of HDR tiles by half stops
+        imageBoxSettings.exposure += (event.key == "+") ? 0.5 : -0.5;
+        this.showContent(this.selection.length-1, this.selection[this.selection.length-1]);
+    } else if (parseInt(event.charCode) == "0".charCodeAt(0)) {
         var idx = 9;
         this.showContent(this.selection.length-1, idx);
     } else {
@@ -437,6 +630,10 @@ ImageBox.prototype.mouseMoveHandler = function(event, image, insets) {
 
     var scale = 2;
     for (var i = 0; i < insets.length; ++i) {
+        if (insets[i].lazyImage) {
+            insets[i].style.backgroundImage = "url('" + insets[i].lazyImage + "')";
+            insets[i].lazyImage = null;
+        }
         insets[i].style.backgroundSize = (image.imWidth * scale) + "px " + (image.imHeight*scale) + "px";
         insets[i].style.backgroundPosition = (insets[i].width/2  - xCoord*scale) + "px "
                                            + (insets[i].height/2 - yCoord*scale) + "px";
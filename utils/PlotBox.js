@@ -65,21 +65,34 @@ var PlotBox = function(parent, title, stats) {
     box.appendChild(selectorGroup);
     box.appendChild(plot);
 
-    // Read data
+    // Read data (tracks in data chunks are only read once their plot is selected)
     this.plots = [];
     for (var i = 0; i < stats[0]["series"].length; i++) {
+        this.plots.push(null);
+    }
+
+    PlotBox.prototype.readPlot = function(idx, callback) {
+        var series = stats[0]["series"][idx];
+        if (typeof(series["track"]) === 'undefined') {
+            loadDataChunk(series["chunk"], function(track) {
+                series["track"] = decodeTrack(track);
+                this.readPlot(idx, callback);
+            }.bind(this));
+            return;
+        }
         var traces = []
-        for (var j = 0; j < stats[0]["series"][i]["track"]['y'].length; ++j) {
+        for (var j = 0; j < series["track"]['y'].length; ++j) {
             var trace = {
-                x: stats[0]["series"][i]["track"]['x'][j],
-                y: stats[0]["series"][i]["track"]['y'][j],
+                x: series["track"]['x'][j],
+                y: series["track"]['y'][j],
                 type: "scatter",
                 name: stats[0]["labels"][j]
             };
             traces.push(trace);
         }
-        this.plots.push(traces);
-    }
+        this.plots[idx] = traces;
+        callback();
+    };
 
     // Styling
     var options = {
@@ -94,6 +107,10 @@ var PlotBox = function(parent, title, stats) {
 
     // Plot selection toggle
     PlotBox.prototype.selectPlot = function(idx) {
+        if (this.plots[idx] === null) {
+            this.readPlot(idx, this.selectPlot.bind(this, idx));
+            return;
+        }
         for (var i = 0; i < this.plots.length; i++) {
             if (i == idx) {
                 this.selectors[i].className += " active";
@@ -104,5 +121,7 @@ var PlotBox = function(parent, title, stats) {
         }
     };
 
-    Plotly.newPlot("metric-plot", this.plots[0], options, {displayModeBar: false});
+    this.readPlot(0, function() {
+        Plotly.newPlot("metric-plot", this.plots[0], options, {displayModeBar: false});
+    }.bind(this));
 }
\ No newline at end of file
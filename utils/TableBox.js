@@ -69,13 +69,14 @@ var TableBox = function(parent, title, stats) {
             td.appendChild(document.createTextNode(stats[i]['series'][j]['label']))
             tr.appendChild(td);
 
+            // Missing values (e.g. error never reached) are empty strings
             var err = stats[i]['series'][j]['data'].map(parseFloat);
-            var bestIdx = err.indexOf(Math.min.apply(null, err.map(Number)));
+            var bestIdx = err.indexOf(Math.min.apply(null, err.filter(function(v) { return !isNaN(v); })));
 
             for (var k = 0; k < stats[i]['series'][j]['data'].length; ++k) {
                 var td = document.createElement("td");
                 td.className = "stats";
-                var valueStr = err[k].toExponential().toString();
+                var valueStr = isNaN(err[k]) ? "-" : err[k].toExponential().toString();
                 if (k == bestIdx) {
                     td.className += " best-stat"
                 }
@@ -84,9 +85,8 @@ var TableBox = function(parent, title, stats) {
             }
             tbody.appendChild(tr);
         }
-        // parent.appendChild(table);
+        box.appendChild(table);
     }
 
-    box.appendChild(table);
     parent.append(box);
 }